@@ -6,13 +6,24 @@ import random
 import sys
 import urllib.request
 import shutil
+import tempfile
 import traceback
 import json
+import re
+import functools
+import hashlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import pandas as pd
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image
 from io import BytesIO
+from urllib.parse import unquote
 import dotenv
 
 # Load environment variables
@@ -26,13 +37,82 @@ sys.path.insert(0, ROOT_DIR)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")  # Get API key from environment or use empty string
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-lite:generateContent"
 
+# Shared HTTP session so product page and image downloads reuse keep-alive connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'})
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=2))
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=2))
+
 # Constants
 SKIN_TONES = [1, 2, 3, 4, 5, 6]
 SKIN_TYPES = ['normal', 'dry', 'oily', 'combination', 'sensitive']
 
+# Images tried in order when no --image is given
+SAMPLE_IMAGES = ("sample_face.png", "gone.png", "me.png", "suhas1.png", "suhas2.png")
+
+# Maximum number of product images downloaded and processed at the same time
+DOWNLOAD_WORKERS = 8
+
+# Background-removed product images are kept here across runs, keyed by a hash of the product URL
+IMAGE_CACHE_DIR = os.environ.get("MIRROR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mirror", "products"))
+# Least recently used cached images are deleted once the cache grows past this size
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("MIRROR_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Face region is downsampled to this size before computing its mean luma
+ANALYSIS_SIZE = (256, 256)
+
+# Brightness (HSV value) cut-offs between skin tones 6 (dark) ... 1 (very light)
+TONE_THRESHOLDS = np.array([120, 140, 160, 180, 200], dtype=np.float32)
+
+# LookFantastic product image URLs embedded in the page HTML, one alternative per attribute style:
+# lazy-loaded desktop images, the lookfantastic.com/images proxy (real URL is in its url= param)
+# and plain thcdn src attributes
+# The patterns are bytes so product pages can be scanned without decoding the whole body
+THCDN_IMAGE_RE = re.compile(
+    rb'data-src-desktop="(?P<desktop>https://static\.thcdn\.com/p[^"]*)"'
+    rb'|src="https://www\.lookfantastic\.com/images\?url=(?P<proxied>https://static\.thcdn\.com[^"&]*)&[^"]*"'
+    rb'|src="(?P<direct>https://static\.thcdn\.com[^"]*)"'
+)
+IMG_TAG_RE = re.compile(rb'<img[^>]*>')
+SRC_ATTR_RE = re.compile(rb'src="([^"]*)"')
+ALT_ATTR_RE = re.compile(rb'alt="([^"]*)"')
+
+# Features used by the recommender, and each feature's position in the feature vector
+FEATURES = ('normal', 'dry', 'oily', 'combination', 'acne', 'sensitive', 'fine lines', 'wrinkles', 'redness',
+            'dull', 'pore', 'pigmentation', 'blackheads', 'whiteheads', 'blemishes', 'dark circles', 'eye bags', 'dark spots')
+FEATURE_INDEX = {feature: i for i, feature in enumerate(FEATURES)}
+
+# HSV bounds for red/pink pixels that might indicate acne (OpenCV hue runs 0-180 and wraps at red)
+RED_HUE_LOW_MAX = 10
+RED_HUE_HIGH_MIN = 170
+RED_MIN_SATURATION = 70
+RED_MIN_VALUE = 50
+# Fraction of red pixels above which the face is flagged as having acne
+ACNE_RED_FRACTION = 0.08
+
+# Skin type indexed by (s_std > 35) << 2 | (avg_y < 130) << 1 | (avg_y > 180)
+SKIN_TYPE_LOOKUP = (
+    'normal',       # Middle values
+    'oily',         # Brighter/shinier complexion
+    'dry',          # Darker/duller complexion
+    'dry',          # (unreachable: avg_y can't be both low and high)
+    'combination',  # High variance in color
+    'combination',
+    'combination',
+    'combination',
+)
+
+# orjson parses Gemini responses several times faster than the json module when it's installed
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+JSON_DECODER = json.JSONDecoder()
+
 # Add rembg for background removal
 try:
-    from rembg import remove as remove_bg
+    from rembg import remove as remove_bg, new_session
     REMBG_AVAILABLE = True
     print("Successfully imported rembg for background removal")
 except ImportError:
@@ -41,13 +121,90 @@ except ImportError:
     try:
         import subprocess
         subprocess.check_call([sys.executable, "-m", "pip", "install", "rembg"])
-        from rembg import remove as remove_bg
+        from rembg import remove as remove_bg, new_session
         REMBG_AVAILABLE = True
         print("Successfully installed and imported rembg")
     except Exception as e:
         print(f"Could not install rembg: {str(e)}")
         print("Will proceed without background removal")
 
+# rembg model used for product cutouts; u2netp is ~5x smaller and faster than the default u2net
+# (set REMBG_MODEL=isnet-general-use for a better quality/speed balance)
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2netp")
+# Optional custom ONNX model for rembg, e.g. an int8 copy of u2netp made with quantize_rembg_model()
+# (rembg caches its downloaded models in ~/.u2net)
+REMBG_MODEL_PATH = os.environ.get("REMBG_MODEL_PATH", "")
+# Alpha matting refines product edges but costs several times the mask inference itself,
+# so it's opt-in (REMBG_ALPHA_MATTING=1)
+REMBG_ALPHA_MATTING = os.environ.get("REMBG_ALPHA_MATTING", "0") == "1"
+# rembg runs its network at 320px, so larger product shots are shrunk before removal
+REMBG_MAX_SIZE = 512
+REMBG_SESSION = None
+REMBG_SESSION_LOCK = threading.Lock()
+
+def get_onnx_providers():
+    """Prefer CUDA for rembg inference when onnxruntime-gpu is installed (pip install rembg[gpu])"""
+    try:
+        import onnxruntime as ort
+        if "CUDAExecutionProvider" in ort.get_available_providers():
+            return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    except ImportError:
+        pass
+    return ["CPUExecutionProvider"]
+
+def get_rembg_session():
+    """Create the rembg model session on first use and reuse it for every image"""
+    global REMBG_SESSION
+    with REMBG_SESSION_LOCK:
+        if REMBG_SESSION is None:
+            providers = get_onnx_providers()
+            if REMBG_MODEL_PATH:
+                # rembg loads arbitrary U2-Net style models through its u2net_custom session
+                print(f"Loading rembg model from {REMBG_MODEL_PATH} ({providers[0]})...")
+                REMBG_SESSION = new_session("u2net_custom", model_path=REMBG_MODEL_PATH, providers=providers)
+            else:
+                print(f"Loading rembg model '{REMBG_MODEL}' ({providers[0]})...")
+                try:
+                    REMBG_SESSION = new_session(REMBG_MODEL, providers=providers)
+                except TypeError:
+                    # Older rembg releases don't accept providers
+                    REMBG_SESSION = new_session(REMBG_MODEL)
+    return REMBG_SESSION
+
+def quantize_rembg_model(model_path, output_path):
+    """Write an int8 (dynamically quantized) copy of a rembg ONNX model for faster CPU inference
+    
+    Use it by setting REMBG_MODEL_PATH to output_path.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+    print(f"Saved quantized model to {output_path}")
+    return output_path
+
+def remove_image_background(img):
+    """Remove the background from a PIL image using the shared rembg session"""
+    session = get_rembg_session()
+    
+    # Shrink large images in place (thumbnail keeps the aspect ratio and never upscales)
+    if max(img.size) > REMBG_MAX_SIZE:
+        img.thumbnail((REMBG_MAX_SIZE, REMBG_MAX_SIZE), Image.LANCZOS)
+    
+    if not REMBG_ALPHA_MATTING:
+        return remove_bg(img, session=session)
+    
+    # Process the image to remove background with more conservative settings
+    # Use alpha_matting to preserve more of the product edges
+    try:
+        return remove_bg(img,
+                         session=session,
+                         alpha_matting=True,
+                         alpha_matting_foreground_threshold=240,
+                         alpha_matting_background_threshold=10,
+                         alpha_matting_erode_size=10)
+    except Exception:
+        # Fallback to standard removal if advanced options fail
+        return remove_bg(img, session=session)
+
 def set_gemini_api_key():
     """Prompt user to enter Gemini API key if not already set"""
     global GEMINI_API_KEY
@@ -68,16 +225,26 @@ def set_gemini_api_key():
     
     return GEMINI_API_KEY
 
+@functools.lru_cache(maxsize=4)
+def read_skincare_csv(csv_path, mtime):
+    """Parse the skincare CSV (cached per path and modification time)"""
+    try:
+        # The pyarrow engine parses multi-threaded in C++ when it's installed
+        df = pd.read_csv(csv_path, engine="pyarrow")
+    except (ImportError, ValueError):
+        df = pd.read_csv(csv_path)
+    print(f"Loaded {len(df)} skincare products from dataset")
+    # Print the actual column names to help with debugging
+    print(f"Dataset columns: {df.columns.tolist()}")
+    return df
+
 def load_skincare_dataset():
     """Load the skincare products dataset"""
     csv_path = os.path.join(ROOT_DIR, "skincare_products_clean.csv")
     
     try:
-        df = pd.read_csv(csv_path)
-        print(f"Loaded {len(df)} skincare products from dataset")
-        # Print the actual column names to help with debugging
-        print(f"Dataset columns: {df.columns.tolist()}")
-        return df
+        # Keying on mtime re-parses the file only when it has changed on disk
+        return read_skincare_csv(csv_path, os.path.getmtime(csv_path))
     except Exception as e:
         print(f"Error loading skincare dataset: {str(e)}")
         return None
@@ -95,136 +262,245 @@ def load_image(image_path):
     
     return img
 
-def analyze_skin_tone(image):
-    """Analyze skin tone using a simplified approach"""
-    # In a real app, this would use your skin tone model
-    # For this simple version, we'll use color averaging to estimate tone
+@dataclass
+class FaceFeatures:
+    """Color-converted face region and its HSV statistics, shared by the analysis functions"""
+    roi_hsv: np.ndarray
+    roi_ycc: np.ndarray
+    means: np.ndarray
+    stds: np.ndarray
+
+def face_roi(image):
+    """Return the middle region of the image as the likely face area (a view, not a copy)"""
+    height, width = image.shape[:2]
+    return image[height//4:3*height//4, width//4:3*width//4]
+
+def extract_features(image):
+    """Convert the face region of an image once and compute the statistics the analyses need"""
+    # Crop first so the color conversions only touch the pixels we use
+    face_region = face_roi(image)
     
-    # Convert to the right color space and get average values
-    hsv_img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    h, s, v = cv2.split(hsv_img)
+    # HSV stays at full resolution: the red-pixel fraction, the saturation spread
+    # and the mean value (max of B, G, R) all change if pixels are averaged first
+    face_hsv = cv2.cvtColor(face_region, cv2.COLOR_BGR2HSV)
     
-    # Take the middle region of the image as likely face area
-    height, width = image.shape[:2]
-    face_region = hsv_img[height//4:3*height//4, width//4:3*width//4]
+    # YCrCb is only used for its mean luma, which is linear in B, G, R, so an
+    # INTER_AREA shrink of a large crop leaves it unchanged (up to rounding)
+    luma_region = face_region
+    if face_region.shape[0] > ANALYSIS_SIZE[1] or face_region.shape[1] > ANALYSIS_SIZE[0]:
+        luma_region = cv2.resize(face_region, ANALYSIS_SIZE, interpolation=cv2.INTER_AREA)
+    face_ycrcb = cv2.cvtColor(luma_region, cv2.COLOR_BGR2YCrCb)
+    
+    # Calculate per-channel mean and standard deviation in one pass
+    hsv_means, hsv_stds = cv2.meanStdDev(face_hsv)
+    
+    return FaceFeatures(roi_hsv=face_hsv, roi_ycc=face_ycrcb, means=hsv_means[:, 0], stds=hsv_stds[:, 0])
+
+def as_face_features(image_or_features):
+    """Accept either a BGR image or precomputed FaceFeatures"""
+    if isinstance(image_or_features, FaceFeatures):
+        return image_or_features
+    return extract_features(image_or_features)
+
+def analyze_face(image):
+    """Analyze skin tone, skin type and acne from a single set of face features"""
+    features = extract_features(image)
+    skin_tone, hsv_avg = analyze_skin_tone(features)
+    has_acne, acne_percent = detect_acne(features)
     
-    # Calculate average color values
-    avg_h = np.mean(face_region[:,:,0])
-    avg_s = np.mean(face_region[:,:,1])
-    avg_v = np.mean(face_region[:,:,2])
+    return {
+        'skin_tone': skin_tone,
+        'hsv_avg': hsv_avg,
+        'skin_type': analyze_skin_type(features),
+        'has_acne': has_acne,
+        'acne_percent': acne_percent,
+    }
+
+def analyze_skin_tone(image):
+    """Analyze skin tone using a simplified approach (accepts an image or FaceFeatures)"""
+    features = as_face_features(image)
+    avg_h, avg_s, avg_v = features.means
     
     # Simple mapping of value (brightness) to skin tone
     # Lower values (darker) = higher tone number
     # This is extremely simplified compared to your actual model
-    if avg_v > 200:
-        skin_tone = 1  # Very light
-    elif avg_v > 180:
-        skin_tone = 2  # Light
-    elif avg_v > 160:
-        skin_tone = 3  # Medium light
-    elif avg_v > 140:
-        skin_tone = 4  # Medium
-    elif avg_v > 120:
-        skin_tone = 5  # Medium dark
-    else:
-        skin_tone = 6  # Dark
+    skin_tone = int(6 - np.searchsorted(TONE_THRESHOLDS, avg_v))
     
     return skin_tone, (avg_h, avg_s, avg_v)
 
 def analyze_skin_type(image):
-    """Determine skin type based on image analysis"""
-    # In a real app, this would use your skin type model
-    # For this simple version, we use color/texture approximation
+    """Determine skin type based on image analysis (accepts an image or FaceFeatures)"""
+    features = as_face_features(image)
     
-    hsv_img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    ycrcb_img = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb)
+    # Standard deviation of saturation as a measure of skin evenness
+    s_std = features.stds[1]
     
-    # Get the middle region of the image (face area)
-    height, width = image.shape[:2]
-    face_region = image[height//4:3*height//4, width//4:3*width//4]
-    face_hsv = hsv_img[height//4:3*height//4, width//4:3*width//4]
-    face_ycrcb = ycrcb_img[height//4:3*height//4, width//4:3*width//4]
-    
-    # Calculate standard deviation of saturation as a measure of skin evenness
-    s_std = np.std(face_hsv[:,:,1])
-    
-    # Calculate average luminance
-    avg_y = np.mean(face_ycrcb[:,:,0])
+    # Average luminance
+    avg_y = cv2.mean(features.roi_ycc)[0]
     
     # Simplified logic for skin type determination
-    if s_std > 35:
-        skin_type = 'combination'  # High variance in color
-    elif avg_y < 130:
-        skin_type = 'dry'  # Darker/duller complexion
-    elif avg_y > 180:
-        skin_type = 'oily'  # Brighter/shinier complexion
-    else:
-        skin_type = 'normal'  # Middle values
-    
-    return skin_type
+    return SKIN_TYPE_LOOKUP[(s_std > 35) << 2 | (avg_y < 130) << 1 | (avg_y > 180)]
 
 def detect_acne(image):
-    """Detect presence of acne in the image"""
-    # In a real app, this would use your acne model
-    # For this simple version, we'll use color analysis to estimate
-    
-    # Convert to the right color space
-    hsv_img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    
-    # Focus on the middle part of the image (face area)
-    height, width = image.shape[:2]
-    face_region = hsv_img[height//4:3*height//4, width//4:3*width//4]
+    """Detect presence of acne in the image (accepts an image or FaceFeatures)"""
+    features = as_face_features(image)
     
     # Look for reddish hues that might indicate acne
-    # Simplified thresholds for red/pink tones
-    lower_red = np.array([0, 70, 50])
-    upper_red = np.array([10, 255, 255])
-    lower_red2 = np.array([170, 70, 50])
-    upper_red2 = np.array([180, 255, 255])
-    
-    # Create masks for red regions
-    mask1 = cv2.inRange(face_region, lower_red, upper_red)
-    mask2 = cv2.inRange(face_region, lower_red2, upper_red2)
-    
-    # Combine masks
-    red_mask = mask1 + mask2
+    # Simplified thresholds for red/pink tones: hue wraps around 0/180,
+    # so red is either end of the hue range with enough saturation and value
+    hue = features.roi_hsv[:,:,0]
+    saturation = features.roi_hsv[:,:,1]
+    value = features.roi_hsv[:,:,2]
+    red_mask = (((hue <= RED_HUE_LOW_MAX) | (hue >= RED_HUE_HIGH_MIN))
+                & (saturation >= RED_MIN_SATURATION) & (value >= RED_MIN_VALUE))
     
     # Calculate percentage of pixels that are in the red range
-    red_pixel_percent = np.sum(red_mask > 0) / (face_region.shape[0] * face_region.shape[1])
+    red_pixel_percent = red_mask.mean()
     
     # ADJUSTED: Use 8% as the threshold for acne detection
-    has_acne = red_pixel_percent > 0.08
+    has_acne = red_pixel_percent > ACNE_RED_FRACTION
     
     return has_acne, red_pixel_percent
 
 def create_feature_vector(skin_type, has_acne, acne_percent=0, concerns=None):
     """Create a feature vector for the recommendation system"""
-    # Features used by the recommender
-    features = ['normal', 'dry', 'oily', 'combination', 'acne', 'sensitive', 'fine lines', 'wrinkles', 'redness',
-               'dull', 'pore', 'pigmentation', 'blackheads', 'whiteheads', 'blemishes', 'dark circles', 'eye bags', 'dark spots']
-    
     # Initialize vector
-    vector = [0] * len(features)
+    vector = np.zeros(len(FEATURES), dtype=np.float32)
     
     # Set skin type
-    if skin_type in features:
-        vector[features.index(skin_type)] = 1
+    idx = FEATURE_INDEX.get(skin_type)
+    if idx is not None:
+        vector[idx] = 1
     
     # Set acne and calculate severity (scale 0-1 based on redness percentage)
     if has_acne:
-        acne_idx = features.index('acne')
         # Normalize acne percentage to a scale of 0-1 for severity
-        acne_severity = min(1.0, acne_percent * 5)  # Cap at 1.0
-        vector[acne_idx] = acne_severity
+        vector[FEATURE_INDEX['acne']] = np.clip(acne_percent * 5, 0.0, 1.0)
 
     # Add additional concerns if provided
     if concerns:
         for concern in concerns:
-            if concern in features:
-                vector[features.index(concern)] = 1
+            idx = FEATURE_INDEX.get(concern)
+            if idx is not None:
+                vector[idx] = 1
     
     return vector
 
+def describe_skin_profile(skin_type, skin_tone, has_acne, acne_percent, concerns=None):
+    """Build the skin profile section of a Gemini prompt"""
+    context = f"""
+        Skin profile:
+        - Skin type: {skin_type}
+        - Skin tone: {skin_tone}/6 (where 1 is lightest, 6 is darkest)
+        - Acne presence: {'Yes' if has_acne else 'No'}
+        - Acne severity: {acne_percent*100:.1f}% (based on redness)
+        """
+    
+    if concerns and len(concerns) > 0:
+        context += f"- Additional concerns: {', '.join(concerns)}\n"
+    
+    return context
+
+# Last dataset preview, stored as id(df) -> (df, preview_csv)
+DATASET_PREVIEW_CACHE = {}
+
+def get_dataset_preview(skincare_df):
+    """Create a condensed CSV version of the dataset to include in a prompt"""
+    # The dataset is cached by load_skincare_dataset, so the preview only needs building once per DataFrame
+    cached = DATASET_PREVIEW_CACHE.get(id(skincare_df))
+    if cached is not None and cached[0] is skincare_df:
+        return cached[1]
+    
+    # Include only necessary columns and a subset of products to keep prompt size manageable
+    # A fixed seed keeps the prompt prefix stable, which lets Gemini reuse its implicit prompt cache
+    sample_products = skincare_df.sample(min(50, len(skincare_df)), random_state=0)
+    # Use the actual column names from the dataset
+    preview = sample_products[['product_name', 'product_url', 'product_type', 'price']].to_csv(index=False)
+    
+    DATASET_PREVIEW_CACHE.clear()
+    DATASET_PREVIEW_CACHE[id(skincare_df)] = (skincare_df, preview)
+    return preview
+
+def parse_json_array(text):
+    """Parse the JSON array at the start of text, ignoring anything after it"""
+    if ORJSON_AVAILABLE:
+        # Fast path: the response is usually just the array
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    # raw_decode stops at the end of the array, so trailing prose or code fences don't matter
+    return JSON_DECODER.raw_decode(text)[0]
+
+def request_gemini_json_array(prompt):
+    """Send a prompt to Gemini and return the JSON array in its response, or None"""
+    # Prepare API request
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": GEMINI_API_KEY
+    }
+    
+    data = {
+        "contents": [
+            {
+                "parts": [
+                    {
+                        "text": prompt
+                    }
+                ]
+            }
+        ],
+        "generationConfig": {
+            "temperature": 0.2,
+            "maxOutputTokens": 2048,
+            "topP": 0.8,
+            "topK": 40
+        }
+    }
+    
+    # Make API request
+    response = requests.post(GEMINI_API_URL, headers=headers, json=data, timeout=30)
+    
+    if response.status_code != 200:
+        print(f"Error from Gemini API: {response.status_code} - {response.text}")
+        return None
+    
+    # orjson parses the raw body directly, skipping the decode to str
+    response_json = orjson.loads(response.content) if ORJSON_AVAILABLE else response.json()
+    
+    # Process the response
+    if "candidates" in response_json and len(response_json["candidates"]) > 0:
+        text_content = response_json["candidates"][0]["content"]["parts"][0]["text"].strip()
+        
+        # Extract the JSON data from the response
+        try:
+            # Find JSON array in text content
+            json_start = text_content.find('[')
+            
+            if json_start >= 0:
+                return parse_json_array(text_content[json_start:])
+            else:
+                print("Could not find valid JSON in Gemini response.")
+                print("Raw response:", text_content)
+                return None
+        except ValueError as e:
+            print(f"Error decoding JSON from Gemini response: {str(e)}")
+            print("Raw response:", text_content)
+            return None
+    else:
+        print("No candidate responses from Gemini API.")
+        return None
+
+def normalize_recommendations(recommendations):
+    """Ensure every recommended product has a url field"""
+    for product in recommendations:
+        # Ensure URL field exists (map from product_url if needed)
+        if 'product_url' in product and not 'url' in product:
+            product['url'] = product['product_url']
+        elif not 'url' in product:
+            product['url'] = None
+    return recommendations
+
 def get_gemini_recommendations(skincare_df, skin_type, skin_tone, has_acne, acne_percent, concerns=None):
     """Get personalized product recommendations using Gemini API"""
     if not GEMINI_API_KEY:
@@ -237,34 +513,24 @@ def get_gemini_recommendations(skincare_df, skin_type, skin_tone, has_acne, acne
     
     try:
         # Create a context string describing the user's skin profile
-        context = f"""
-        Skin profile:
-        - Skin type: {skin_type}
-        - Skin tone: {skin_tone}/6 (where 1 is lightest, 6 is darkest)
-        - Acne presence: {'Yes' if has_acne else 'No'}
-        - Acne severity: {acne_percent*100:.1f}% (based on redness)
-        """
-        
-        if concerns and len(concerns) > 0:
-            context += f"- Additional concerns: {', '.join(concerns)}\n"
+        context = describe_skin_profile(skin_type, skin_tone, has_acne, acne_percent, concerns)
         
         # Create a condensed version of the dataset to include in the prompt
-        # Include only necessary columns and a subset of products to keep prompt size manageable
-        sample_products = skincare_df.sample(min(50, len(skincare_df)))
-        # Use the actual column names from the dataset
-        dataset_preview = sample_products[['product_name', 'product_url', 'product_type', 'price']].to_csv(index=False)
+        dataset_preview = get_dataset_preview(skincare_df)
         
         # Prepare the prompt for Gemini
+        # The dataset sample comes first so every request shares the same prompt prefix,
+        # which Gemini's implicit context caching can reuse; only the skin profile varies
         prompt = f"""
         You are a skincare expert recommendation system. Based on a user's skin profile and a dataset of skincare products, 
         recommend 10 appropriate products for their needs.
 
-        {context}
-
         Below is a sample from the skincare product dataset:
 
         {dataset_preview}
 
+        {context}
+
         Analyze the properties of these products and select 10 products that would work best for this skin profile.
         Consider the following factors:
         - Choose products appropriate for the user's skin type
@@ -283,75 +549,16 @@ def get_gemini_recommendations(skincare_df, skin_type, skin_tone, has_acne, acne
         Only include the JSON array in your response, nothing else.
         """
         
-        # Prepare API request
-        headers = {
-            "Content-Type": "application/json",
-            "x-goog-api-key": GEMINI_API_KEY
-        }
-        
-        data = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "text": prompt
-                        }
-                    ]
-                }
-            ],
-            "generationConfig": {
-                "temperature": 0.2,
-                "maxOutputTokens": 2048,
-                "topP": 0.8,
-                "topK": 40
-            }
-        }
-        
-        # Make API request
         print("Requesting personalized recommendations from Gemini...")
-        response = requests.post(GEMINI_API_URL, headers=headers, json=data, timeout=30)
-        
-        if response.status_code != 200:
-            print(f"Error from Gemini API: {response.status_code} - {response.text}")
+        recommendations = request_gemini_json_array(prompt)
+        if recommendations is None:
             return None
         
-        response_json = response.json()
+        # Process recommendations to ensure they have the right fields
+        normalize_recommendations(recommendations)
         
-        # Process the response
-        if "candidates" in response_json and len(response_json["candidates"]) > 0:
-            text_content = response_json["candidates"][0]["content"]["parts"][0]["text"].strip()
-            
-            # Extract the JSON data from the response
-            try:
-                # Find JSON array in text content
-                json_start = text_content.find('[')
-                json_end = text_content.rfind(']') + 1
-                
-                if json_start >= 0 and json_end > json_start:
-                    json_str = text_content[json_start:json_end]
-                    recommendations = json.loads(json_str)
-                    
-                    # Process recommendations to ensure they have the right fields
-                    for product in recommendations:
-                        # Ensure URL field exists (map from product_url if needed)
-                        if 'product_url' in product and not 'url' in product:
-                            product['url'] = product['product_url']
-                        elif not 'url' in product:
-                            product['url'] = None
-                    
-                    print(f"Successfully received {len(recommendations)} product recommendations from Gemini")
-                    return recommendations
-                else:
-                    print("Could not find valid JSON in Gemini response.")
-                    print("Raw response:", text_content)
-                    return None
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON from Gemini response: {str(e)}")
-                print("Raw response:", text_content)
-                return None
-        else:
-            print("No candidate responses from Gemini API.")
-            return None
+        print(f"Successfully received {len(recommendations)} product recommendations from Gemini")
+        return recommendations
     
     except Exception as e:
         print(f"Error getting recommendations from Gemini: {str(e)}")
@@ -380,122 +587,140 @@ def find_image_for_product(product):
         print(f"Error finding image for product: {str(e)}")
         return None
 
+def decode_image(content, content_type=''):
+    """Decode downloaded image bytes into a PIL image"""
+    # OpenCV decodes JPEGs with libjpeg-turbo, which is faster than going through PIL.
+    # It ignores the EXIF orientation here so both branches return the same pixels as Image.open.
+    if 'jpeg' in content_type or 'jpg' in content_type:
+        bgr = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if bgr is not None:
+            return Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+    
+    # PNG/WebP (and anything OpenCV couldn't read) keep going through PIL
+    return Image.open(BytesIO(content))
+
+def extract_lookfantastic_image_urls(html_content):
+    """Extract candidate product image URLs from the raw bytes of a LookFantastic product page"""
+    # Single scan over the page; keep desktop, proxied and direct matches in that priority order
+    desktop_urls, proxied_urls, direct_urls = [], [], []
+    for match in THCDN_IMAGE_RE.finditer(html_content):
+        if match.group('desktop'):
+            desktop_urls.append(match.group('desktop').decode('utf-8', 'replace'))
+        elif match.group('proxied'):
+            # URL might be URL encoded
+            proxied_urls.append(unquote(match.group('proxied').decode('utf-8', 'replace')))
+        elif match.group('direct'):
+            direct_urls.append(match.group('direct').decode('utf-8', 'replace'))
+    img_urls = desktop_urls + proxied_urls + direct_urls
+    
+    # If none of the specific patterns worked, fallback to generic img tag parsing
+    if not img_urls:
+        for img_match in IMG_TAG_RE.finditer(html_content):
+            img_tag = img_match.group(0)
+            src_match = SRC_ATTR_RE.search(img_tag)
+            if not src_match or not src_match.group(1):
+                continue
+            img_src = src_match.group(1)
+            
+            # Skip promotional banner images
+            img_tag_lower = img_tag.lower()
+            if b'brand hasn' in img_tag_lower or b'banner' in img_tag_lower:
+                continue
+            alt_match = ALT_ATTR_RE.search(img_tag)
+            if alt_match:
+                alt_text = alt_match.group(1).lower()
+                if b"brand hasn't joined" in alt_text or b"banner" in alt_text:
+                    continue
+            
+            # Check if it's a product image and not a promotional banner
+            if b"static.thcdn.com" in img_src:
+                img_urls.append(img_src.decode('utf-8', 'replace'))
+    
+    return img_urls
+
+def save_response_body(response, save_path):
+    """Write a (streamed) response body to disk in chunks instead of buffering it whole"""
+    with open(save_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+
+def image_cache_path(url):
+    """Path of the cached background-removed PNG for a product URL"""
+    # The rembg settings are part of the key so changing them doesn't serve stale cutouts
+    key_source = f"{REMBG_MODEL_PATH or REMBG_MODEL}:{REMBG_ALPHA_MATTING}:{url}".encode()
+    key = hashlib.blake2b(key_source, digest_size=16).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, key + ".png")
+
+def cache_processed_image(url, save_path):
+    """Keep a copy of a background-removed image so later runs can skip the download and rembg"""
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        # Copy to a temporary name first so concurrent downloads never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst, open(save_path, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.replace(temp_path, image_cache_path(url))
+        except OSError:
+            os.unlink(temp_path)
+            raise
+    except OSError as e:
+        print(f"Could not cache processed image: {str(e)}")
+
+def prune_image_cache(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    """Delete the least recently used cached images until IMAGE_CACHE_DIR fits in max_bytes"""
+    entries = []
+    total = 0
+    try:
+        with os.scandir(IMAGE_CACHE_DIR) as it:
+            for entry in it:
+                # .tmp files are copies still being written
+                if entry.is_file(follow_symlinks=False) and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+    except OSError:
+        return
+    
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
 def download_image(url, save_path):
     """Download an image from URL, remove background, and save it to the specified path"""
+    # Reuse the processed image from a previous run if we have one
+    cache_path = image_cache_path(url)
+    if os.path.exists(cache_path):
+        try:
+            shutil.copyfile(cache_path, save_path)
+            # Bump the mtime so pruning treats this as recently used
+            os.utime(cache_path)
+            print(f"Using cached image for {url}")
+            return True
+        except OSError as e:
+            print(f"Could not read cached image: {str(e)}")
+    
     try:
-        # Create a request with a User-Agent header to avoid being blocked
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        
+        # Requests go through HTTP_SESSION, which sends a browser User-Agent to avoid being blocked
         # Check if the URL is a LookFantastic product page
         if 'lookfantastic.com' in url and not url.endswith(('.jpg', '.jpeg', '.png', '.gif')):
             print(f"Detected LookFantastic product page, extracting image URL...")
             
             # Method 1: Try to access the product page and extract img src
             try:
-                response = requests.get(url, headers=headers, timeout=15)
+                response = HTTP_SESSION.get(url, timeout=15)
                 
                 if response.status_code == 200:
-                    html_content = response.text
+                    # URLs are ASCII, so scan the raw bytes and skip charset detection and decoding
+                    html_content = response.content
                     
-                    # Look for image tags in the HTML
-                    img_urls = []
-                    # First look for product images specifically
-                    main_img_patterns = [
-                        'data-src-desktop="https://static.thcdn.com/p',
-                        'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com',
-                        'src="https://static.thcdn.com'
-                    ]
-                    
-                    for pattern in main_img_patterns:
-                        start_index = 0
-                        while True:
-                            pattern_start = html_content.find(pattern, start_index)
-                            if pattern_start == -1:
-                                break
-                                
-                            # Extract the URL based on pattern
-                            if pattern == 'data-src-desktop="https://static.thcdn.com/p':
-                                quote_start = pattern_start + len('data-src-desktop="')
-                                quote_end = html_content.find('"', quote_start)
-                                if quote_end > quote_start:
-                                    img_url = html_content[quote_start:quote_end]
-                                    img_urls.append(img_url)
-                            elif pattern == 'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com':
-                                quote_start = pattern_start + len('src="')
-                                quote_end = html_content.find('"', quote_start)
-                                if quote_end > quote_start:
-                                    img_url = html_content[quote_start:quote_end]
-                                    # Extract the actual image URL from the parameter
-                                    url_param_start = img_url.find("url=") + 4
-                                    url_param_end = img_url.find("&", url_param_start)
-                                    if url_param_end > url_param_start:
-                                        direct_url = img_url[url_param_start:url_param_end]
-                                        # URL might be URL encoded
-                                        try:
-                                            from urllib.parse import unquote
-                                            direct_url = unquote(direct_url)
-                                            img_urls.append(direct_url)
-                                        except:
-                                            img_urls.append(direct_url)
-                            elif pattern == 'src="https://static.thcdn.com':
-                                quote_start = pattern_start + len('src="')
-                                quote_end = html_content.find('"', quote_start)
-                                if quote_end > quote_start:
-                                    img_url = html_content[quote_start:quote_end]
-                                    img_urls.append(img_url)
-                                    
-                            start_index = pattern_start + len(pattern)
-                    
-                    # If none of the specific patterns worked, fallback to generic img tag parsing
-                    if not img_urls:
-                        start_idx = 0
-                        while True:
-                            img_start = html_content.find('<img', start_idx)
-                            if img_start == -1:
-                                break
-                            
-                            img_end = html_content.find('>', img_start)
-                            if img_end == -1:
-                                break
-                            
-                            img_tag = html_content[img_start:img_end+1]
-                            
-                            if 'src="' in img_tag:
-                                src_start = img_tag.find('src="') + 5
-                                src_end = img_tag.find('"', src_start)
-                                if src_start > 5 and src_end > src_start:
-                                    img_src = img_tag[src_start:src_end]
-                                    
-                                    # Skip promotional banner images
-                                    skip_image = False
-                                    if 'brand hasn' in img_tag.lower() or 'banner' in img_tag.lower():
-                                        skip_image = True
-                                    if 'alt="' in img_tag:
-                                        alt_start = img_tag.find('alt="') + 5
-                                        alt_end = img_tag.find('"', alt_start)
-                                        if alt_end > alt_start:
-                                            alt_text = img_tag[alt_start:alt_end].lower()
-                                            if "brand hasn't joined" in alt_text or "banner" in alt_text:
-                                                skip_image = True
-                                    
-                                    # Check if it's a product image and not a promotional banner
-                                    if not skip_image and ("static.thcdn.com" in img_src):
-                                        img_urls.append(img_src)
-                                    elif not skip_image and ("lookfantastic.com/images" in img_src and "static.thcdn.com" in img_src):
-                                        # Extract the direct thcdn URL
-                                        url_param_start = img_src.find("url=") + 4
-                                        url_param_end = img_src.find("&", url_param_start)
-                                        if url_param_end > url_param_start:
-                                            direct_url = img_src[url_param_start:url_param_end]
-                                            # URL might be URL encoded
-                                            try:
-                                                from urllib.parse import unquote
-                                                direct_url = unquote(direct_url)
-                                                img_urls.append(direct_url)
-                                            except:
-                                                img_urls.append(direct_url)
-                            
-                            start_idx = img_end + 1
+                    # Look for product image URLs in the HTML
+                    img_urls = extract_lookfantastic_image_urls(html_content)
                     
                     # Method 2: Try to generate image URL from product ID if no images found
                     if not img_urls:
@@ -516,31 +741,21 @@ def download_image(url, save_path):
                     for img_url in img_urls:
                         print(f"Trying image URL: {img_url}")
                         try:
-                            img_response = requests.get(img_url, headers=headers, timeout=10)
-                            if img_response.status_code == 200 and 'image' in img_response.headers.get('Content-Type', ''):
+                            # Stream so only the headers are fetched until we know it's an image
+                            img_response = HTTP_SESSION.get(img_url, timeout=10, stream=True)
+                            img_content_type = img_response.headers.get('Content-Type', '')
+                            if img_response.status_code == 200 and 'image' in img_content_type:
                                 # We got a valid image, process it
-                                image_data = BytesIO(img_response.content)
-                                
                                 if REMBG_AVAILABLE:
                                     try:
                                         # Remove background using rembg
                                         print(f"Removing background from image...")
-                                        img = Image.open(image_data)
-                                        
-                                        # Process the image to remove background with more conservative settings
-                                        # Use alpha_matting to preserve more of the product edges
-                                        try:
-                                            output = remove_bg(img, 
-                                                              alpha_matting=True, 
-                                                              alpha_matting_foreground_threshold=240,
-                                                              alpha_matting_background_threshold=10,
-                                                              alpha_matting_erode_size=10)
-                                        except:
-                                            # Fallback to standard removal if advanced options fail
-                                            output = remove_bg(img)
+                                        img = decode_image(img_response.content, img_content_type)
+                                        output = remove_image_background(img)
                                         
                                         # Save the processed image with transparency
                                         output.save(save_path, format="PNG")
+                                        cache_processed_image(url, save_path)
                                         print(f"Background removed and image saved to {save_path}")
                                         return True
                                     except Exception as e:
@@ -552,10 +767,12 @@ def download_image(url, save_path):
                                         return True
                                 else:
                                     # If rembg is not available, save the original image
-                                    with open(save_path, 'wb') as f:
-                                        f.write(img_response.content)
+                                    save_response_body(img_response, save_path)
                                     print(f"Saved image without background removal (rembg not available)")
                                     return True
+                            else:
+                                # Not an image, so don't download the body
+                                img_response.close()
                         except Exception as e:
                             print(f"Failed to download from {img_url}: {str(e)}")
                     
@@ -571,7 +788,7 @@ def download_image(url, save_path):
             try:
                 product_name = url.split('/')[-2].replace('-', ' ').title()
                 placeholder_url = f"https://via.placeholder.com/500x500.png?text={product_name}"
-                placeholder_response = requests.get(placeholder_url, headers=headers, timeout=10)
+                placeholder_response = HTTP_SESSION.get(placeholder_url, timeout=10)
                 if placeholder_response.status_code == 200:
                     with open(save_path, 'wb') as f:
                         f.write(placeholder_response.content)
@@ -583,35 +800,22 @@ def download_image(url, save_path):
             return False
         
         # If not a LookFantastic page or direct image URL, just download it normally
-        response = requests.get(url, headers=headers, timeout=10)
+        response = HTTP_SESSION.get(url, timeout=10, stream=True)
         response.raise_for_status()  # Raise exception for bad responses
         
         # Check if response is an image
         content_type = response.headers.get('Content-Type', '')
         if 'image' in content_type:
-            # Load image from response content
-            image_data = BytesIO(response.content)
-            
             if REMBG_AVAILABLE:
                 try:
                     # Remove background using rembg
                     print(f"Removing background from image...")
-                    img = Image.open(image_data)
-                    
-                    # Process the image to remove background with more conservative settings
-                    # Use alpha_matting to preserve more of the product edges
-                    try:
-                        output = remove_bg(img, 
-                                          alpha_matting=True, 
-                                          alpha_matting_foreground_threshold=240,
-                                          alpha_matting_background_threshold=10,
-                                          alpha_matting_erode_size=10)
-                    except:
-                        # Fallback to standard removal if advanced options fail
-                        output = remove_bg(img)
+                    img = decode_image(response.content, content_type)
+                    output = remove_image_background(img)
                     
                     # Save the processed image with transparency
                     output.save(save_path, format="PNG")
+                    cache_processed_image(url, save_path)
                     print(f"Background removed and image saved to {save_path}")
                     return True
                 except Exception as e:
@@ -623,17 +827,28 @@ def download_image(url, save_path):
                     return True
             else:
                 # If rembg is not available, save the original image
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
+                save_response_body(response, save_path)
                 print(f"Saved image without background removal (rembg not available)")
                 return True
         else:
+            response.close()
             print(f"URL does not point to an image: {url}")
             return False
     except Exception as e:
         print(f"Error downloading image from {url}: {str(e)}")
         return False
 
+class FilenameTranslation(dict):
+    """str.translate table that keeps alphanumerics, '_', '.' and '-' and maps everything else to '_'"""
+    def __missing__(self, codepoint):
+        # Filled in lazily so non-ASCII letters are judged by isalnum() like any other character
+        char = chr(codepoint)
+        replacement = char if char.isalnum() or char in '_.-' else '_'
+        self[codepoint] = replacement
+        return replacement
+
+FILENAME_TRANSLATION = FilenameTranslation()
+
 def process_gemini_recommendations(recommendations, recommendations_dir):
     """Process and save product recommendations from Gemini"""
     if not recommendations or len(recommendations) == 0:
@@ -651,33 +866,49 @@ def process_gemini_recommendations(recommendations, recommendations_dir):
                 categories[category] = []
             categories[category].append(product)
         
+        # Display product info for each category in a single write
+        lines = []
+        for category, products in categories.items():
+            if products:
+                lines.append(f"\n{category.upper()}:")
+                for product in products:
+                    lines.append(f"- {product['brand']} {product['name']} (${product['price']})")
+                    lines.append(f"  Reason: {product['reason']}")
+                    if 'url' in product:
+                        lines.append(f"  URL: {product['url']}")
+        print("\n".join(lines))
+        
         # Process each category
         product_count = 1
+        download_jobs = []
         for category, products in categories.items():
             if products:
-                print(f"\n{category.upper()}:")
                 for product in products:
-                    # Display product info
-                    print(f"- {product['brand']} {product['name']} (${product['price']})")
-                    print(f"  Reason: {product['reason']}")
-                    if 'url' in product:
-                        print(f"  URL: {product['url']}")
-                    
-                    # Find and download product image
+                    # Find product image
                     img_url = find_image_for_product(product)
                     if img_url:
                         # Create a unique filename
                         filename = f"rec_{product_count}_{category}_{product['brand']}_{product['name']}.png"
                         # Remove problematic characters from filename
-                        filename = "".join(c if c.isalnum() or c in ['_', '.', '-'] else '_' for c in filename)
+                        filename = filename.translate(FILENAME_TRANSLATION)
                         img_path = os.path.join(recommendations_dir, filename)
-                        
-                        # Download the image and remove background
-                        if download_image(img_url, img_path):
-                            print(f"  Image saved: recommendations/{filename}")
+                        download_jobs.append((img_url, img_path, filename))
                         
                     product_count += 1
         
+        # Download the images and remove backgrounds concurrently
+        # Each product is independent and mostly waiting on the network
+        if download_jobs:
+            print(f"\nDownloading {len(download_jobs)} product images...")
+            with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(download_jobs))) as executor:
+                results = list(executor.map(lambda job: download_image(job[0], job[1]), download_jobs))
+            prune_image_cache()
+            
+            saved_lines = [f"  Image saved: recommendations/{filename}"
+                           for (img_url, img_path, filename), saved in zip(download_jobs, results) if saved]
+            if saved_lines:
+                print("\n".join(saved_lines))
+        
         print("\nProduct recommendations processing complete.")
         return True
     except Exception as e:
@@ -685,6 +916,36 @@ def process_gemini_recommendations(recommendations, recommendations_dir):
         print(traceback.format_exc())
         return False
 
+# Gemini recommendations per quantized skin profile, stored as key -> (timestamp, recommendations)
+RECOMMENDATION_CACHE = {}
+RECOMMENDATION_CACHE_TTL = 600  # seconds
+RECOMMENDATION_CACHE_SIZE = 256
+RECOMMENDATION_CACHE_LOCK = threading.Lock()
+
+def recommendation_cache_key(skin_type, skin_tone, has_acne, acne_percent, concerns=None):
+    """Cache key for a skin profile, with acne severity bucketed to the nearest 5%"""
+    return (skin_type, skin_tone, bool(has_acne), round(acne_percent * 20), tuple(sorted(concerns or ())))
+
+def get_cached_recommendations(key):
+    """Return cached recommendations for key, or None if missing or expired"""
+    with RECOMMENDATION_CACHE_LOCK:
+        entry = RECOMMENDATION_CACHE.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > RECOMMENDATION_CACHE_TTL:
+            del RECOMMENDATION_CACHE[key]
+            return None
+        return entry[1]
+
+def cache_recommendations(key, recommendations):
+    """Store recommendations for key, evicting the oldest entry when the cache is full"""
+    with RECOMMENDATION_CACHE_LOCK:
+        RECOMMENDATION_CACHE.pop(key, None)
+        if len(RECOMMENDATION_CACHE) >= RECOMMENDATION_CACHE_SIZE:
+            # Dicts keep insertion order, so the first key is the oldest
+            del RECOMMENDATION_CACHE[next(iter(RECOMMENDATION_CACHE))]
+        RECOMMENDATION_CACHE[key] = (time.monotonic(), recommendations)
+
 def get_gemini_powered_recommendations(skin_type, skin_tone, has_acne, acne_percent, concerns=None):
     """Get recommendations using Gemini's analysis of the skincare dataset"""
     try:
@@ -696,15 +957,14 @@ def get_gemini_powered_recommendations(skin_type, skin_tone, has_acne, acne_perc
         
         # Create recommendations folder if it doesn't exist
         recommendations_dir = os.path.join(ROOT_DIR, "recommendations")
-        if not os.path.exists(recommendations_dir):
-            os.makedirs(recommendations_dir)
-            print(f"Created recommendations folder at {recommendations_dir}")
+        os.makedirs(recommendations_dir, exist_ok=True)
         
         # Clean up old recommendations
-        for filename in os.listdir(recommendations_dir):
-            file_path = os.path.join(recommendations_dir, filename)
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
+        # scandir entries already know their type, so there's no extra stat per file
+        with os.scandir(recommendations_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    os.unlink(entry.path)
         
         # Load the skincare dataset
         skincare_df = load_skincare_dataset()
@@ -712,15 +972,23 @@ def get_gemini_powered_recommendations(skin_type, skin_tone, has_acne, acne_perc
             print("Error: Could not load skincare dataset. Using fallback recommendations.")
             return False
         
-        # Get personalized recommendations from Gemini
-        recommendations = get_gemini_recommendations(
-            skincare_df, 
-            skin_type, 
-            skin_tone, 
-            has_acne, 
-            acne_percent, 
-            concerns
-        )
+        # Reuse recent recommendations for the same skin profile instead of asking Gemini again
+        cache_key = recommendation_cache_key(skin_type, skin_tone, has_acne, acne_percent, concerns)
+        recommendations = get_cached_recommendations(cache_key)
+        if recommendations is not None:
+            print("Using cached recommendations for this skin profile")
+        else:
+            # Get personalized recommendations from Gemini
+            recommendations = get_gemini_recommendations(
+                skincare_df, 
+                skin_type, 
+                skin_tone, 
+                has_acne, 
+                acne_percent, 
+                concerns
+            )
+            if recommendations:
+                cache_recommendations(cache_key, recommendations)
         
         if recommendations:
             # Process and save the recommendations
@@ -737,49 +1005,53 @@ def get_gemini_powered_recommendations(skin_type, skin_tone, has_acne, acne_perc
 
 def get_fallback_skincare_recommendations(skin_type, has_acne):
     """Fallback skincare product recommendations if model fails"""
-    print("\nRECOMMENDED SKINCARE PRODUCTS:")
+    # Collect the output and write it once at the end
+    lines = []
+    lines.append("\nRECOMMENDED SKINCARE PRODUCTS:")
     
     # Cleansers
-    print("\nCLEANSERS:")
+    lines.append("\nCLEANSERS:")
     if skin_type == 'oily' or has_acne:
-        print("- CeraVe Foaming Facial Cleanser ($15)")
-        print("- La Roche-Posay Effaclar Purifying Foaming Gel ($23)")
+        lines.append("- CeraVe Foaming Facial Cleanser ($15)")
+        lines.append("- La Roche-Posay Effaclar Purifying Foaming Gel ($23)")
     elif skin_type == 'dry':
-        print("- CeraVe Hydrating Facial Cleanser ($15)")
-        print("- Neutrogena Hydro Boost Hydrating Cleansing Gel ($12)")
+        lines.append("- CeraVe Hydrating Facial Cleanser ($15)")
+        lines.append("- Neutrogena Hydro Boost Hydrating Cleansing Gel ($12)")
     else:
-        print("- Cetaphil Gentle Skin Cleanser ($14)")
-        print("- Kiehl's Ultra Facial Cleanser ($22)")
+        lines.append("- Cetaphil Gentle Skin Cleanser ($14)")
+        lines.append("- Kiehl's Ultra Facial Cleanser ($22)")
     
     # Moisturizers
-    print("\nMOISTURIZERS:")
+    lines.append("\nMOISTURIZERS:")
     if skin_type == 'oily':
-        print("- Neutrogena Hydro Boost Water Gel ($24)")
-        print("- La Roche-Posay Effaclar Mat ($32)")
+        lines.append("- Neutrogena Hydro Boost Water Gel ($24)")
+        lines.append("- La Roche-Posay Effaclar Mat ($32)")
     elif skin_type == 'dry':
-        print("- CeraVe Moisturizing Cream ($19)")
-        print("- First Aid Beauty Ultra Repair Cream ($34)")
+        lines.append("- CeraVe Moisturizing Cream ($19)")
+        lines.append("- First Aid Beauty Ultra Repair Cream ($34)")
     elif skin_type == 'combination':
-        print("- Clinique Dramatically Different Moisturizing Gel ($30)")
-        print("- Belif The True Cream Aqua Bomb ($38)")
+        lines.append("- Clinique Dramatically Different Moisturizing Gel ($30)")
+        lines.append("- Belif The True Cream Aqua Bomb ($38)")
     else:
-        print("- Neutrogena Oil-Free Moisture ($12)")
-        print("- Kiehl's Ultra Facial Cream ($32)")
+        lines.append("- Neutrogena Oil-Free Moisture ($12)")
+        lines.append("- Kiehl's Ultra Facial Cream ($32)")
     
     # Treatments
-    print("\nTREATMENTS:")
+    lines.append("\nTREATMENTS:")
     if has_acne:
-        print("- Paula's Choice 2% BHA Liquid Exfoliant ($30)")
-        print("- The Ordinary Niacinamide 10% + Zinc 1% ($6)")
+        lines.append("- Paula's Choice 2% BHA Liquid Exfoliant ($30)")
+        lines.append("- The Ordinary Niacinamide 10% + Zinc 1% ($6)")
     elif skin_type == 'dry':
-        print("- The Ordinary Hyaluronic Acid 2% + B5 ($7)")
-        print("- Fresh Rose Deep Hydration Face Cream ($42)")
+        lines.append("- The Ordinary Hyaluronic Acid 2% + B5 ($7)")
+        lines.append("- Fresh Rose Deep Hydration Face Cream ($42)")
     elif skin_type == 'combination':
-        print("- The Ordinary Azelaic Acid Suspension 10% ($8)")
-        print("- Sunday Riley Good Genes All-In-One Lactic Acid Treatment ($85)")
+        lines.append("- The Ordinary Azelaic Acid Suspension 10% ($8)")
+        lines.append("- Sunday Riley Good Genes All-In-One Lactic Acid Treatment ($85)")
     else:
-        print("- Drunk Elephant C-Firma Vitamin C Day Serum ($80)")
-        print("- The Ordinary Buffet ($15)")
+        lines.append("- Drunk Elephant C-Firma Vitamin C Day Serum ($80)")
+        lines.append("- The Ordinary Buffet ($15)")
+    
+    print("\n".join(lines))
 
 def main():
     # Parse arguments
@@ -787,8 +1059,15 @@ def main():
     parser.add_argument('--image', type=str, help='Path to an existing image file')
     parser.add_argument('--concerns', nargs='+', help='Additional skin concerns (e.g., redness pigmentation)', default=[])
     parser.add_argument('--api-key', type=str, help='Google Gemini API key')
+    parser.add_argument('--preview', action='store_true', help='Show the input image for 2 seconds before analysis')
+    parser.add_argument('--quantize-rembg', nargs=2, metavar=('MODEL', 'OUTPUT'),
+                        help='Write an int8 copy of a rembg ONNX model (use it with REMBG_MODEL_PATH) and exit')
     args = parser.parse_args()
     
+    if args.quantize_rembg:
+        quantize_rembg_model(*args.quantize_rembg)
+        return
+    
     print("Starting skin analysis system with Gemini-powered recommendations...")
     
     # Set API key if provided
@@ -804,37 +1083,17 @@ def main():
     
     # If no image is provided, look for sample images
     if not args.image:
-        # First check images directory
-        images_dir = os.path.join(ROOT_DIR, "images")
-        if os.path.exists(images_dir):
-            for sample_file in ["sample_face.png", "gone.png", "me.png", "suhas1.png", "suhas2.png"]:
-                img_path = os.path.join(images_dir, sample_file)
-                if os.path.exists(img_path):
-                    image_path = img_path
-                    print(f"No image provided, using sample image: {image_path}")
-                    break
-            else:
-                # Then check current directory
-                for sample_file in ["sample_face.png", "gone.png", "me.png", "suhas1.png"]:
-                    if os.path.exists(sample_file):
-                        image_path = sample_file
-                        print(f"No image provided, using sample image: {image_path}")
-                        break
-                else:
-                    print("ERROR: No image provided and no sample images found.")
-                    print("Please provide an image with: python gemini.py --image path/to/image.png")
-                    return
-        else:
-            # Check in current directory
-            for sample_file in ["sample_face.png", "gone.png", "me.png", "suhas1.png"]:
-                if os.path.exists(sample_file):
-                    image_path = sample_file
-                    print(f"No image provided, using sample image: {image_path}")
-                    break
-            else:
-                print("ERROR: No image provided and no sample images found.")
-                print("Please provide an image with: python gemini.py --image path/to/image.png")
-                return
+        # First check images directory, then current directory
+        candidates = itertools.chain(
+            (os.path.join(ROOT_DIR, "images", sample_file) for sample_file in SAMPLE_IMAGES),
+            SAMPLE_IMAGES
+        )
+        image_path = next((path for path in candidates if os.path.exists(path)), None)
+        if image_path is None:
+            print("ERROR: No image provided and no sample images found.")
+            print("Please provide an image with: python gemini.py --image path/to/image.png")
+            return
+        print(f"No image provided, using sample image: {image_path}")
     else:
         # Check if the provided path exists
         if os.path.exists(args.image):
@@ -854,26 +1113,30 @@ def main():
     if image is None:
         return
     
-    # Display the image
-    try:
-        cv2.imshow("Analysis Image", image)
-        cv2.waitKey(2000)  # Show for 2 seconds
-    except Exception as e:
-        print(f"Warning: Could not display image: {e}")
+    # Display the image (opt-in, since it blocks for 2 seconds)
+    if args.preview:
+        try:
+            cv2.imshow("Analysis Image", image)
+            cv2.waitKey(2000)  # Show for 2 seconds
+        except Exception as e:
+            print(f"Warning: Could not display image: {e}")
     
     # Analyze skin
     print("\nAnalyzing skin...\n")
     
+    # Skin tone, skin type and acne all come from one pass over the face region
+    analysis = analyze_face(image)
+    
     # Get skin tone
-    skin_tone, hsv_avg = analyze_skin_tone(image)
+    skin_tone = analysis['skin_tone']
     print(f"Detected skin tone: {skin_tone}/6 (where 1 is lightest, 6 is darkest)")
     
     # Get skin type
-    skin_type = analyze_skin_type(image)
+    skin_type = analysis['skin_type']
     print(f"Detected skin type: {skin_type}")
     
     # Check for acne (using 8% threshold)
-    has_acne, acne_percent = detect_acne(image)
+    has_acne, acne_percent = analysis['has_acne'], analysis['acne_percent']
     print(f"Acne detected: {'Yes' if has_acne else 'No'} ({acne_percent*100:.1f}% redness)")
     
     # Show additional concerns if provided
@@ -887,7 +1150,8 @@ def main():
         get_fallback_skincare_recommendations(skin_type, has_acne)
     
     # Clean up
-    cv2.destroyAllWindows()
+    if args.preview:
+        cv2.destroyAllWindows()
     print("\nAnalysis complete!")
     print(f"Recommendation images with removed backgrounds are in: {os.path.join(ROOT_DIR, 'recommendations')}")
 
@@ -2,6 +2,8 @@ import os
 import google.generativeai as genai
 from fastai.vision.all import *
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import numpy as np
 from PIL import Image
@@ -11,23 +13,91 @@ import shutil
 import sys
 import pandas as pd
 import re
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, unquote, urlsplit
 from bs4 import BeautifulSoup
 import time
 import random
-import tempfile
-import gc
+import functools
+import hashlib
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# Configure Gemini API
+# Gemini answers per hair profile are kept here across runs
+GEMINI_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mirror", "gemini_hair_recommendations")
+GEMINI_CACHE_LOCK = threading.Lock()
+# Cached answers older than this are asked for again, so new products and model updates show up
+GEMINI_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+# Hair type predictions per image file (path, mtime and size) are kept here across runs
+HAIR_PREDICTION_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mirror", "hair_predictions")
+HAIR_MODEL_PATH = 'models/hair-resnet18-model.pkl'
+
+# Maximum number of products searched and downloaded at the same time
+PRODUCT_WORKERS = 5
+# Search and product page requests to the same host are spaced this many seconds apart (a random
+# value in the range), however many workers are running, to avoid rate limiting
+HOST_REQUEST_INTERVAL = (1.0, 2.0)
+HOST_REQUEST_LOCK = threading.Lock()
+# Earliest time (time.monotonic) the next request to each host may start
+HOST_NEXT_REQUEST = {}
+# Product image downloads above this size are abandoned
+MAX_IMAGE_BYTES = 8_000_000
+# Background removal models are large, so only one image goes through them at a time
+BACKGROUND_REMOVAL_LOCK = threading.Lock()
+
+# Image URLs embedded in a Google image search results page
+GOOGLE_IMAGE_URL_RE = re.compile(r'https://[^"\']+\.(?:jpg|jpeg|png|webp)')
+# LookFantastic product image URLs embedded in the page, one alternative per source:
+# imageUrl fields in embedded JSON data, lazy-loaded desktop images, the lookfantastic.com/images
+# proxy (real URL is in its url= param) and plain thcdn src attributes
+PAGE_IMAGE_URL_RE = re.compile(
+    r'"imageUrl"\s*:\s*"(?P<json>https:[^"]+)"'
+    r'|data-src-desktop="(?P<desktop>https://static\.thcdn\.com/p[^"]*)"'
+    r'|src="https://www\.lookfantastic\.com/images\?url=(?P<proxied>https://static\.thcdn\.com[^"&]*)&[^"]*"'
+    r'|src="(?P<direct>https://static\.thcdn\.com[^"]*)"'
+)
+# Substrings (lowercase) that mark thumbnails, icons and other non-product images
+GOOGLE_SKIP_TOKENS = ('icon', 'thumb', 'small')
+LOOKFANTASTIC_SKIP_TOKENS = ('icon', 'thumb', 'logo')
+# File extensions accepted as product images
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Shared HTTP session so repeated LookFantastic/Google/image requests reuse keep-alive connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'DNT': '1',
+    'Upgrade-Insecure-Requests': '1',
+})
+# Retry transient failures with backoff; raise_on_status=False still hands back the last response
+# so callers keep reporting the status code themselves
+HTTP_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=HTTP_RETRY))
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=HTTP_RETRY))
+
+# Gemini API key (the client is configured on first use, see get_gemini_model)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    print("Please set your GEMINI_API_KEY environment variable")
-    print("You can get one at: https://ai.google.dev/")
-    GEMINI_API_KEY = input("Enter your Gemini API key: ").strip()
-    os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
+GEMINI_MODEL_NAME = 'gemini-1.5-pro'  # Updated to use stable 1.5 version
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-pro')  # Updated to use stable 1.5 version
+def require_gemini_key():
+    """Return the Gemini API key, or raise if it isn't configured"""
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY is not set. You can get one at: https://ai.google.dev/")
+    return GEMINI_API_KEY
+
+@functools.lru_cache(maxsize=1)
+def get_gemini_model():
+    """Configure the Gemini client on first use and reuse the model for every request"""
+    genai.configure(api_key=require_gemini_key())
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+# Run CarveKit on the GPU in half precision when one is available
+CARVEKIT_DEVICE = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+CARVEKIT_FP16 = CARVEKIT_DEVICE.startswith('cuda')
+# Images per CarveKit segmentation batch when several products are processed together
+CARVEKIT_BATCH_SIZE = 4
 
 # Try CarveKit for much better background removal
 CARVEKIT_AVAILABLE = False
@@ -37,21 +107,6 @@ try:
     CARVEKIT_AVAILABLE = True
     print("Successfully imported CarveKit for high-quality background removal")
     
-    # Initialize CarveKit with optimal settings for product images
-    # This uses multiple AI models and ensemble methods for better results
-    carvekit_interface = HiInterface(
-        object_type="product",  # Optimized for product images
-        batch_size_seg=1,       # Process one image at a time for segmentation
-        batch_size_matting=1,   # Process one image at a time for matting
-        seg_mask_size=640,      # Higher resolution for better detail
-        matting_mask_size=2048, # High resolution matting
-        trimap_prob_threshold=231, # Default trimap threshold
-        trimap_dilation=30,     # Default dilation
-        trimap_erosion_iters=5, # Default erosion iterations
-        device='cpu',           # Use CPU (change to 'cuda:0' if you have a compatible GPU)
-        fp16=False              # Don't use half-precision for CPU
-    )
-    
 except ImportError:
     CARVEKIT_AVAILABLE = False
     print("CarveKit not installed. Will attempt to install it.")
@@ -69,20 +124,6 @@ except ImportError:
         from carvekit.api.high import HiInterface
         from carvekit.api.interface import Interface
         
-        # Initialize CarveKit with optimal settings for product images
-        carvekit_interface = HiInterface(
-            object_type="product",  # Optimized for product images
-            batch_size_seg=1,       # Process one image at a time for segmentation
-            batch_size_matting=1,   # Process one image at a time for matting
-            seg_mask_size=640,      # Higher resolution for better detail
-            matting_mask_size=2048, # High resolution matting
-            trimap_prob_threshold=231, # Default trimap threshold
-            trimap_dilation=30,     # Default dilation
-            trimap_erosion_iters=5, # Default erosion iterations
-            device='cpu',           # Use CPU (change to 'cuda:0' if you have GPU)
-            fp16=False              # Don't use half-precision for CPU
-        )
-        
         CARVEKIT_AVAILABLE = True
         print("Successfully installed and configured CarveKit")
     except Exception as e:
@@ -98,6 +139,37 @@ except ImportError:
         except:
             print("Failed to install rembg fallback. Background removal will be limited.")
 
+CARVEKIT_INTERFACE = None
+CARVEKIT_INTERFACE_LOCK = threading.Lock()
+
+def get_carvekit_interface():
+    """Load the CarveKit models on first use, so importing this module stays cheap"""
+    global CARVEKIT_INTERFACE
+    with CARVEKIT_INTERFACE_LOCK:
+        if CARVEKIT_INTERFACE is None:
+            # Initialize CarveKit with optimal settings for product images
+            # This uses multiple AI models and ensemble methods for better results
+            CARVEKIT_INTERFACE = HiInterface(
+                object_type="product",  # Optimized for product images
+                batch_size_seg=CARVEKIT_BATCH_SIZE, # Segment several product images per forward pass
+                batch_size_matting=1,   # Matting runs at 2048px, so keep it one image at a time
+                seg_mask_size=640,      # Higher resolution for better detail
+                matting_mask_size=2048, # High resolution matting
+                trimap_prob_threshold=231, # Default trimap threshold
+                trimap_dilation=30,     # Default dilation
+                trimap_erosion_iters=5, # Default erosion iterations
+                device=CARVEKIT_DEVICE, # GPU if available, otherwise CPU
+                fp16=CARVEKIT_FP16      # Half precision only on GPU
+            )
+    return CARVEKIT_INTERFACE
+
+# rembg is the fallback background remover (imported once here, not on every fallback)
+try:
+    from rembg import remove as remove_bg
+    REMBG_AVAILABLE = True
+except ImportError:
+    REMBG_AVAILABLE = False
+
 # Install BeautifulSoup if not already installed
 try:
     from bs4 import BeautifulSoup
@@ -111,6 +183,13 @@ except ImportError:
         print(f"Could not install BeautifulSoup: {str(e)}")
         print("Some functionality may be limited")
 
+# lxml is a C parser and much faster than the pure-Python html.parser; use it when installed
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
 class AlbumentationsTransform(RandTransform):
     "A transform handler for multiple `Albumentation` transforms"
     split_idx, order = None, 2
@@ -122,9 +201,9 @@ class AlbumentationsTransform(RandTransform):
     
     def encodes(self, img: PILImage):
         if self.idx == 0:
-            aug_img = self.train_aug(image=np.array(img))['image']
+            aug_img = self.train_aug(image=np.asarray(img))['image']
         else:
-            aug_img = self.valid_aug(image=np.array(img))['image']
+            aug_img = self.valid_aug(image=np.asarray(img))['image']
         return PILImage.create(aug_img)
 
 def get_valid_aug(sz):
@@ -132,53 +211,106 @@ def get_valid_aug(sz):
         A.Resize(sz, sz)
     ], p=1.)
 
+@functools.lru_cache(maxsize=1)
+def get_hair_learner(model_path=HAIR_MODEL_PATH):
+    """Load the hair type model once and reuse it for every prediction"""
+    learn = load_learner(model_path)
+    learn.model.eval()
+    return learn
+
+def predict_hair_batch(img_paths):
+    """Predict hair types for several images with batched forward passes
+    
+    Returns a (prediction, probabilities) tuple per image, in input order.
+    """
+    learn = get_hair_learner()
+    
+    # One test DataLoader for all images instead of a batch-of-1 per image
+    dl = learn.dls.test_dl([PILImage.create(p) for p in img_paths])
+    with learn.no_bar():
+        probs, _ = learn.get_preds(dl=dl)
+    
+    vocab = learn.dls.vocab
+    results = []
+    for row in probs:
+        pred = vocab[int(row.argmax())]
+        # Return both prediction and probabilities dictionary
+        probabilities = {vocab[i]: float(row[i]) for i in range(len(vocab))}
+        results.append((str(pred), probabilities))
+    return results
+
+def hair_image_key(img_path):
+    """Identify an image file and model version by path, modification time and size"""
+    image_stat = os.stat(img_path)
+    model_stat = os.stat(HAIR_MODEL_PATH)
+    return (os.path.abspath(img_path), image_stat.st_mtime_ns, image_stat.st_size,
+            model_stat.st_mtime_ns, model_stat.st_size)
+
+@functools.lru_cache(maxsize=64)
+def cached_hair_prediction(image_key):
+    """Prediction for an image key from hair_image_key, cached in memory and in a shelve file"""
+    key = hashlib.sha1(json.dumps(image_key).encode()).hexdigest()
+    try:
+        os.makedirs(os.path.dirname(HAIR_PREDICTION_CACHE_PATH), exist_ok=True)
+        with shelve.open(HAIR_PREDICTION_CACHE_PATH) as cache:
+            if key in cache:
+                print("Using cached hair type prediction for this image")
+                return cache[key]
+    except Exception as e:
+        # A broken cache file shouldn't stop predictions
+        print(f"Prediction cache unavailable: {e}")
+    
+    prediction = predict_hair_batch([image_key[0]])[0]
+    
+    try:
+        with shelve.open(HAIR_PREDICTION_CACHE_PATH) as cache:
+            cache[key] = prediction
+    except Exception as e:
+        print(f"Could not cache hair type prediction: {e}")
+    return prediction
+
 def predict_hair(img_path):
     try:
-        # Load the model
-        model_path = 'models/hair-resnet18-model.pkl'
-        learn = load_learner(model_path)
-        
-        # Load and predict on the image - using test_model.py logic
-        img = PILImage.create(img_path)
-        pred, pred_idx, probs = learn.predict(img)
-        
-        # Return both prediction and probabilities dictionary
-        probabilities = {learn.dls.vocab[i]: float(probs[i]) for i in range(len(learn.dls.vocab))}
-        return str(pred), probabilities
+        # Unchanged images skip the model entirely
+        return cached_hair_prediction(hair_image_key(img_path))
     except Exception as e:
         print(f"Error in prediction: {e}")
         return None, None
 
-def get_recommendations(hair_type, dandruff, moisture, hair_density):
-    """Get personalized hair product recommendations based on hair attributes"""
+def recommendation_prompt(hair_type, dandruff, moisture, hair_density):
+    """The Gemini prompt asking for product recommendations for a hair profile"""
+    return (
+        f"You are a hair care expert. Based on this profile:\n"
+        f"- Hair Type: {hair_type}\n"
+        f"- Dandruff: {dandruff}\n"
+        f"- Moisture Level: {moisture}\n"
+        f"- Hair Density: {hair_density}\n\n"
+        f"Recommend 5 specific hair products with these requirements:\n"
+        f"1. Each product must be from a different mainstream, well-known brand (like L'Oreal, Pantene, etc.)\n"
+        f"2. Include a mix of product types (shampoo, conditioner, serum, etc.)\n"
+        f"3. All products should be specific (include full product name and brand)\n"
+        f"4. Each product should be available on LookFantastic.com or similar retailers\n\n"
+        f"For each product, provide:\n"
+        f"1. Exact product name with brand\n"
+        f"2. Product type (shampoo, conditioner, etc.)\n"
+        f"3. Estimated price range\n"
+        f"4. A brief explanation of why it's good for this hair type\n\n"
+        f"Format your response as a JSON array with each product having these fields:\n"
+        f"- name (full product name including brand)\n"
+        f"- brand (just the brand name)\n"
+        f"- type (product type/category)\n"
+        f"- price_estimate (numeric value only in USD, without currency symbol)\n"
+        f"- reason (brief explanation of why this product is good for this hair)\n\n"
+        f"Only include the JSON array in your response, nothing else."
+    )
+
+def request_recommendations(hair_type, dandruff, moisture, hair_density):
+    """Ask Gemini for hair product recommendations (uncached)"""
     try:
-        prompt = (
-            f"You are a hair care expert. Based on this profile:\n"
-            f"- Hair Type: {hair_type}\n"
-            f"- Dandruff: {dandruff}\n"
-            f"- Moisture Level: {moisture}\n"
-            f"- Hair Density: {hair_density}\n\n"
-            f"Recommend 5 specific hair products with these requirements:\n"
-            f"1. Each product must be from a different mainstream, well-known brand (like L'Oreal, Pantene, etc.)\n"
-            f"2. Include a mix of product types (shampoo, conditioner, serum, etc.)\n"
-            f"3. All products should be specific (include full product name and brand)\n"
-            f"4. Each product should be available on LookFantastic.com or similar retailers\n\n"
-            f"For each product, provide:\n"
-            f"1. Exact product name with brand\n"
-            f"2. Product type (shampoo, conditioner, etc.)\n"
-            f"3. Estimated price range\n"
-            f"4. A brief explanation of why it's good for this hair type\n\n"
-            f"Format your response as a JSON array with each product having these fields:\n"
-            f"- name (full product name including brand)\n"
-            f"- brand (just the brand name)\n"
-            f"- type (product type/category)\n"
-            f"- price_estimate (numeric value only in USD, without currency symbol)\n"
-            f"- reason (brief explanation of why this product is good for this hair)\n\n"
-            f"Only include the JSON array in your response, nothing else."
-        )
+        prompt = recommendation_prompt(hair_type, dandruff, moisture, hair_density)
         
         # Generate recommendations
-        response = model.generate_content(prompt)
+        response = get_gemini_model().generate_content(prompt)
         response_text = response.text if hasattr(response, 'text') else response.parts[0].text
         
         # Extract JSON data from the response
@@ -203,6 +335,56 @@ def get_recommendations(hair_type, dandruff, moisture, hair_density):
         print(f"Error getting recommendations: {e}")
         return None
 
+@functools.lru_cache(maxsize=256)
+def cached_recommendations(profile):
+    """Recommendations for a (hair_type, dandruff, moisture, hair_density) profile
+    
+    Cached in memory and in a shelve file across runs, for up to GEMINI_CACHE_TTL.
+    Raises ValueError when Gemini gives no usable answer, so failures aren't cached.
+    """
+    # Key on the model and the full prompt (which includes the profile), so changing
+    # either one asks Gemini again instead of reusing an answer to a different question
+    key_source = json.dumps([GEMINI_MODEL_NAME, recommendation_prompt(*profile)])
+    key = hashlib.sha1(key_source.encode()).hexdigest()
+    os.makedirs(os.path.dirname(GEMINI_CACHE_PATH), exist_ok=True)
+    
+    with GEMINI_CACHE_LOCK, shelve.open(GEMINI_CACHE_PATH) as cache:
+        entry = cache.get(key)
+        # Entries are (time.time() when stored, recommendations)
+        if entry is not None and time.time() - entry[0] <= GEMINI_CACHE_TTL:
+            print("Using cached recommendations for this hair profile")
+            return entry[1]
+    
+    recommendations = request_recommendations(*profile)
+    if recommendations is None:
+        raise ValueError("No recommendations from Gemini")
+    
+    with GEMINI_CACHE_LOCK, shelve.open(GEMINI_CACHE_PATH) as cache:
+        cache[key] = (time.time(), recommendations)
+    return recommendations
+
+def get_recommendations(hair_type, dandruff, moisture, hair_density):
+    """Get personalized hair product recommendations based on hair attributes"""
+    profile = tuple(str(value).strip() for value in (hair_type, dandruff, moisture, hair_density))
+    try:
+        return cached_recommendations(profile)
+    except ValueError:
+        return None
+    except Exception as e:
+        # A broken cache file shouldn't stop recommendations
+        print(f"Recommendation cache unavailable: {e}")
+        return request_recommendations(hair_type, dandruff, moisture, hair_density)
+
+def wait_for_host(url):
+    """Block until the next request to url's host is allowed, reserving the following slot"""
+    host = urlsplit(url).netloc
+    with HOST_REQUEST_LOCK:
+        now = time.monotonic()
+        start = max(now, HOST_NEXT_REQUEST.get(host, now))
+        HOST_NEXT_REQUEST[host] = start + random.uniform(*HOST_REQUEST_INTERVAL)
+    # Sleep outside the lock so workers waiting on other hosts aren't held up
+    time.sleep(start - now)
+
 def search_product_on_lookfantastic(product_name, brand):
     """Search for a product on LookFantastic and return the product URL"""
     try:
@@ -212,26 +394,16 @@ def search_product_on_lookfantastic(product_name, brand):
         search_query = f"{brand} {product_name}"
         search_url = f"https://www.lookfantastic.com/search?q={quote_plus(search_query)}"
         
-        # Create headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.lookfantastic.com/',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        # Send the request
-        response = requests.get(search_url, headers=headers, timeout=15)
+        # Send the request (HTTP_SESSION already sends browser headers)
+        wait_for_host(search_url)
+        response = HTTP_SESSION.get(search_url, headers={'Referer': 'https://www.lookfantastic.com/'}, timeout=15)
         
         if response.status_code != 200:
             print(f"Failed to search LookFantastic: {response.status_code}")
             return None
         
         # Parse the HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(response.content, HTML_PARSER)
         
         # Find product links
         product_links = []
@@ -274,19 +446,9 @@ def search_product_on_google(product_name, brand, product_type):
         search_query = f"{brand} {product_name} {product_type} product image"
         search_url = f"https://www.google.com/search?q={quote_plus(search_query)}&tbm=isch"
         
-        # Create headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.google.com/',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        # Send the request
-        response = requests.get(search_url, headers=headers, timeout=15)
+        # Send the request (HTTP_SESSION already sends browser headers)
+        wait_for_host(search_url)
+        response = HTTP_SESSION.get(search_url, headers={'Referer': 'https://www.google.com/'}, timeout=15)
         
         if response.status_code != 200:
             print(f"Failed to search Google: {response.status_code}")
@@ -296,13 +458,13 @@ def search_product_on_google(product_name, brand, product_type):
         image_urls = []
         
         # Extract image URLs using regex pattern matching (more reliable than parsing)
-        pattern = r'https://[^"\']+\.(?:jpg|jpeg|png|webp)'
-        matches = re.findall(pattern, response.text)
+        matches = GOOGLE_IMAGE_URL_RE.findall(response.text)
         
         # Filter out low-quality and thumbnail images
         for url in matches:
             # Skip small thumbnails and icons
-            if 'icon' in url.lower() or 'thumb' in url.lower() or 'small' in url.lower():
+            url_lower = url.lower()
+            if any(token in url_lower for token in GOOGLE_SKIP_TOKENS):
                 continue
             # Skip Google UI images
             if 'google.com' in url:
@@ -324,30 +486,60 @@ def search_product_on_google(product_name, brand, product_type):
         print(f"Error searching Google for product image: {str(e)}")
         return None
 
+def extract_json_ld_images(soup):
+    """Collect product image URLs from the page's application/ld+json blocks"""
+    img_urls = []
+    for script in soup.find_all('script', type='application/ld+json'):
+        try:
+            data = json.loads(script.string or '')
+        except ValueError:
+            continue
+        
+        # A block can hold one object, a list of them, or an @graph of them
+        items = data if isinstance(data, list) else data.get('@graph', [data]) if isinstance(data, dict) else []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            images = item.get('image')
+            # image may be a URL, a list of URLs or ImageObjects
+            for image in images if isinstance(images, list) else [images]:
+                if isinstance(image, dict):
+                    image = image.get('url') or image.get('contentUrl')
+                if isinstance(image, str):
+                    img_urls.append(image)
+    return img_urls
+
+def filter_product_image_urls(img_urls):
+    """Drop duplicates, thumbnails/UI images and non-image URLs, keeping the original order"""
+    # dict.fromkeys dedupes the normalized URLs while preserving order
+    return [
+        url for url in dict.fromkeys(url.strip() for url in img_urls)
+        # Skip small thumbnails and UI elements, and non-image URLs (the extension has to
+        # end the path, ignoring any query string)
+        if not any(token in url.lower() for token in LOOKFANTASTIC_SKIP_TOKENS)
+        and url.lower().split('?', 1)[0].endswith(IMAGE_SUFFIXES)
+    ]
+
 def get_product_image_from_lookfantastic(product_url):
     """Extract the product image from a LookFantastic product page"""
     try:
         print(f"Extracting image from {product_url}...")
         
-        # Create headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        # Send the request
-        response = requests.get(product_url, headers=headers, timeout=15)
+        # Send the request (HTTP_SESSION already sends browser headers)
+        wait_for_host(product_url)
+        response = HTTP_SESSION.get(product_url, timeout=15)
         
         if response.status_code != 200:
             print(f"Failed to access product page: {response.status_code}")
             return None
         
         # Parse HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(response.content, HTML_PARSER)
+        
+        # The structured product data carries the canonical image, so try it before scanning the page
+        json_ld_urls = filter_product_image_urls(extract_json_ld_images(soup))
+        if json_ld_urls:
+            return json_ld_urls[0]
         
         # Try multiple selectors for product images
         img_urls = []
@@ -369,77 +561,27 @@ def get_product_image_from_lookfantastic(product_url):
             if 'src' in img.attrs:
                 img_urls.append(img['src'])
         
-        # Extract image URLs from JSON data in the page
-        json_pattern = r'"imageUrl"\s*:\s*"(https:[^"]+)"'
-        json_matches = re.findall(json_pattern, response.text)
-        img_urls.extend(json_matches)
-        
-        # Pattern match directly in HTML for specific patterns
-        static_patterns = [
-            'data-src-desktop="https://static.thcdn.com/p',
-            'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com',
-            'src="https://static.thcdn.com'
-        ]
-        
-        for pattern in static_patterns:
-            start_index = 0
-            while True:
-                pattern_start = response.text.find(pattern, start_index)
-                if pattern_start == -1:
-                    break
-                
-                # Extract the URL based on pattern
-                if pattern == 'data-src-desktop="https://static.thcdn.com/p':
-                    quote_start = pattern_start + len('data-src-desktop="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        img_urls.append(img_url)
-                elif pattern == 'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com':
-                    quote_start = pattern_start + len('src="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        # Extract the actual image URL from the parameter
-                        url_param_start = img_url.find("url=") + 4
-                        url_param_end = img_url.find("&", url_param_start)
-                        if url_param_end > url_param_start:
-                            direct_url = img_url[url_param_start:url_param_end]
-                            # URL might be URL encoded
-                            try:
-                                from urllib.parse import unquote
-                                direct_url = unquote(direct_url)
-                                img_urls.append(direct_url)
-                            except:
-                                img_urls.append(direct_url)
-                elif pattern == 'src="https://static.thcdn.com':
-                    quote_start = pattern_start + len('src="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        img_urls.append(img_url)
-                
-                start_index = pattern_start + len(pattern)
+        # Extract image URLs from JSON data in the page and pattern match directly in HTML
+        # for specific patterns, all in a single scan of the page text;
+        # keep JSON, desktop, proxied and direct matches in that priority order
+        json_urls, desktop_urls, proxied_urls, direct_urls = [], [], [], []
+        for match in PAGE_IMAGE_URL_RE.finditer(response.text):
+            if match.group('json'):
+                json_urls.append(match.group('json'))
+            elif match.group('desktop'):
+                desktop_urls.append(match.group('desktop'))
+            elif match.group('proxied'):
+                # Extract the actual image URL from the parameter; it might be URL encoded
+                proxied_urls.append(unquote(match.group('proxied')))
+            elif match.group('direct'):
+                direct_urls.append(match.group('direct'))
+        img_urls.extend(json_urls)
+        img_urls.extend(desktop_urls)
+        img_urls.extend(proxied_urls)
+        img_urls.extend(direct_urls)
         
         # Filter out non-product images and duplicates
-        filtered_urls = []
-        seen = set()
-        for url in img_urls:
-            # Normalize URL to avoid duplicates
-            url = url.strip()
-            if url in seen:
-                continue
-            seen.add(url)
-            
-            # Skip small thumbnails and UI elements
-            if 'icon' in url.lower() or 'thumb' in url.lower() or 'logo' in url.lower():
-                continue
-            
-            # Skip non-image URLs
-            if not any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                continue
-                
-            filtered_urls.append(url)
+        filtered_urls = filter_product_image_urls(img_urls)
         
         if not filtered_urls:
             print("Could not find any product images on the page")
@@ -482,130 +624,190 @@ def find_product_image(product_name, brand, product_type):
         print(f"Error finding product image: {str(e)}")
         return None, None
 
-def download_image(url, save_path):
-    """Download an image from URL, remove background, and save it to the specified path"""
-    try:
-        # Skip placeholder images
-        if "placeholder.com" in url:
-            print(f"Skipping placeholder image")
-            return False
-            
-        # Create a request with a User-Agent header to avoid being blocked
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        
-        # Direct download for image URLs
-        response = requests.get(url, headers=headers, timeout=10)
+def fetch_image_bytes(url):
+    """Download an image URL and return its bytes, or None if it isn't a usable image"""
+    # Skip placeholder images
+    if "placeholder.com" in url:
+        print(f"Skipping placeholder image")
+        return None
         
+    # Direct download for image URLs (HTTP_SESSION sends a User-Agent header to avoid being blocked)
+    # Streamed, so the body is only read once the headers say it's a usable image
+    with HTTP_SESSION.get(url, timeout=10, stream=True) as response:
         # Check if response is successful
         if response.status_code != 200:
             print(f"Failed to download image: {response.status_code}")
-            return False
+            return None
             
         # Check if response is an image
         content_type = response.headers.get('Content-Type', '')
-        if 'image' in content_type:
-            # Load image from response content
-            image_data = BytesIO(response.content)
-            
-            # Use CarveKit for better background removal
-            if CARVEKIT_AVAILABLE:
-                try:
-                    print(f"Removing background with CarveKit (high quality)...")
-                    
-                    # Load the image
-                    img = Image.open(image_data)
-                    
-                    # Check image quality and size
-                    # Resize if too large for better processing
-                    max_size = 1500
-                    if max(img.size) > max_size:
-                        ratio = max_size / max(img.size)
-                        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                        img = img.resize(new_size, Image.LANCZOS)
-                        print(f"Resized image to {new_size} for better processing")
-                    
-                    # Save to temp file if needed (some CarveKit models require file path)
-                    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                        img.save(tmp.name)
-                        tmp_path = tmp.name
-                    
-                    try:
-                        # Process with CarveKit
-                        # This uses multiple models and ensemble methods for better results
-                        processed_images = carvekit_interface([tmp_path])
-                        
-                        if processed_images and len(processed_images) > 0:
-                            # Get the result and save it
-                            result = processed_images[0]
-                            result.save(save_path)
-                            print(f"Background removed with CarveKit and saved to {save_path}")
-                            
-                            # Clean up temp file
-                            os.unlink(tmp_path)
-                            
-                            # Free memory (CarveKit can use a lot)
-                            del processed_images
-                            gc.collect()
-                            
-                            return True
-                    except Exception as e:
-                        print(f"Error with CarveKit processing: {e}")
-                        # If the temp file exists, clean up
-                        if os.path.exists(tmp_path):
-                            os.unlink(tmp_path)
-                        
-                        # Try alternative approach with direct processing
-                        print("Trying alternative CarveKit approach...")
-                        try:
-                            result = carvekit_interface.process_image(img)
-                            result.save(save_path)
-                            print(f"Background removed with alternative CarveKit method and saved to {save_path}")
-                            return True
-                        except Exception as e2:
-                            print(f"Alternative approach also failed: {e2}")
-                            # Fall through to rembg fallback
-                            
-                except Exception as e:
-                    print(f"CarveKit error: {e}")
-                    # Continue to fallback methods
-                    
-            # If CarveKit isn't available or failed, try rembg if available
+        if 'image' not in content_type:
+            print(f"URL does not point to an image: {url}")
+            return None
+        
+        # Read the body in chunks, giving up on anything too large to be a product shot
+        buffer = BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer.write(chunk)
+            if buffer.tell() > MAX_IMAGE_BYTES:
+                print(f"Image is larger than {MAX_IMAGE_BYTES // 1_000_000} MB, skipping: {url}")
+                return None
+        return buffer.getvalue()
+
+def save_if_already_cut_out(image_bytes, save_path):
+    """Save images that already have a transparent background as-is; returns True if it did"""
+    img = Image.open(BytesIO(image_bytes))
+    if img.mode not in ('RGBA', 'LA'):
+        return False
+    
+    # Only skip background removal if the alpha channel is actually used
+    if np.asarray(img.getchannel('A')).min() >= 250:
+        return False
+    
+    img.save(save_path, 'PNG')
+    print(f"Image already has a transparent background, saved to {save_path}")
+    return True
+
+def prepare_image_for_removal(image_bytes):
+    """Load downloaded image bytes for background removal, shrinking very large images"""
+    img = Image.open(BytesIO(image_bytes))
+    
+    # Check image quality and size
+    # Resize if too large for better processing
+    # (the models resample internally, so a fast in-place BILINEAR thumbnail is enough)
+    max_size = 1500
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.BILINEAR)
+        print(f"Resized image to {img.size} for better processing")
+    
+    return img
+
+def rembg_remove_background(img):
+    """Remove the background from a PIL image with rembg"""
+    with BACKGROUND_REMOVAL_LOCK:
+        return remove_bg(img, alpha_matting=True, alpha_matting_foreground_threshold=240)
+
+# Per-image fallbacks for images the batched CarveKit pass couldn't handle,
+# in order of preference, as (name, function taking and returning a PIL image)
+BACKGROUND_REMOVERS = []
+if REMBG_AVAILABLE:
+    BACKGROUND_REMOVERS.append(('rembg', rembg_remove_background))
+
+def remove_background_and_save(image_bytes, save_path):
+    """Save the first successful background removal, or the original image if none works"""
+    try:
+        img = prepare_image_for_removal(image_bytes) if BACKGROUND_REMOVERS else None
+    except Exception as e:
+        print(f"Could not load image for background removal: {e}")
+        img = None
+    
+    if img is not None:
+        for name, remove_background in BACKGROUND_REMOVERS:
             try:
-                from rembg import remove as remove_bg
-                print("Using rembg as fallback...")
-                
-                # Load the image
-                img = Image.open(image_data)
-                
-                # Process with rembg
-                output = remove_bg(img, alpha_matting=True, alpha_matting_foreground_threshold=240)
-                
-                # Save the result
-                output.save(save_path, format="PNG")
-                print(f"Background removed with rembg fallback and saved to {save_path}")
-                return True
-                
-            except ImportError:
-                print("No background removal libraries available. Saving original image.")
-                # Save the original image if all background removal methods fail
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"Saved original image without background removal")
+                print(f"Removing background with {name}...")
+                remove_background(img).save(save_path, format="PNG")
+                print(f"Background removed with {name} and saved to {save_path}")
                 return True
-                
             except Exception as e:
-                print(f"Error with fallback background removal: {e}")
-                # Save original image if all attempts fail
-                with open(save_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"Saved original image without background removal")
-                return True
+                print(f"Error with {name} background removal: {e}")
+    else:
+        print("No background removal libraries available. Saving original image.")
+    
+    # Save the original image if all background removal methods fail
+    with open(save_path, 'wb') as f:
+        f.write(image_bytes)
+    print(f"Saved original image without background removal")
+    return True
+
+def remove_backgrounds(images_bytes, save_paths):
+    """Remove backgrounds from several downloaded images with one batched CarveKit call
+    
+    Images CarveKit can't handle go through the remaining background removers. Returns
+    a success flag per image.
+    """
+    results = [None] * len(images_bytes)
+    
+    # Images that already have a transparent background are saved as-is
+    done = []
+    for image_bytes, save_path in zip(images_bytes, save_paths):
+        try:
+            done.append(save_if_already_cut_out(image_bytes, save_path))
+        except Exception:
+            done.append(False)
+    
+    if CARVEKIT_AVAILABLE and not all(done):
+        # Load every image first so one unreadable download doesn't sink the whole batch
+        batch_indices, batch_images = [], []
+        for i, image_bytes in enumerate(images_bytes):
+            if done[i]:
+                continue
+            try:
+                batch_images.append(prepare_image_for_removal(image_bytes))
+                batch_indices.append(i)
+            except Exception as e:
+                print(f"Could not load image for CarveKit: {e}")
+        
+        if batch_images:
+            try:
+                print(f"Removing background from {len(batch_images)} images with CarveKit (high quality)...")
+                # CarveKit splits the list into batches of CARVEKIT_BATCH_SIZE for segmentation
+                with BACKGROUND_REMOVAL_LOCK, torch.inference_mode():
+                    processed_images = get_carvekit_interface()(batch_images)
+                for i, result in zip(batch_indices, processed_images):
+                    results[i] = result
+            except Exception as e:
+                print(f"Error with CarveKit processing: {e}")
+    
+    saved = []
+    for image_bytes, save_path, result, already_saved in zip(images_bytes, save_paths, results, done):
+        if already_saved:
+            saved.append(True)
+        elif result is not None:
+            result.save(save_path)
+            print(f"Background removed with CarveKit and saved to {save_path}")
+            saved.append(True)
         else:
-            print(f"URL does not point to an image: {url}")
-            return False
-    except Exception as e:
-        print(f"Error downloading image from {url}: {str(e)}")
-        return False
+            saved.append(remove_background_and_save(image_bytes, save_path))
+    return saved
+
+def process_hair_product(product, product_type, product_count, recommendations_dir):
+    """Find and download the image for one product
+    
+    Returns (product info, image path, image bytes), or None if no image could be downloaded.
+    """
+    # Get product info
+    brand = product.get('brand', 'Unknown')
+    name = product.get('name', 'Unknown Product')
+    
+    # Find product image (the search requests are paced per host by wait_for_host)
+    image_url, product_url = find_product_image(name, brand, product_type)
+    
+    if image_url:
+        # Create a unique filename with limited length
+        filename = f"hair_rec_{product_count}_{product_type}_{brand[:20]}.png"
+        # Remove problematic characters from filename
+        filename = "".join(c if c.isalnum() or c in ['_', '.', '-'] else '_' for c in filename)
+        img_path = os.path.join(recommendations_dir, filename)
+        
+        # Download the image; background removal happens later for all products at once
+        try:
+            image_bytes = fetch_image_bytes(image_url)
+        except Exception as e:
+            print(f"Error downloading image from {image_url}: {str(e)}")
+            image_bytes = None
+        
+        if image_bytes is not None:
+            # Store successful product with URL
+            successful_product = product.copy()
+            successful_product['image_url'] = image_url
+            if product_url:
+                successful_product['product_url'] = product_url
+            return successful_product, img_path, image_bytes
+        else:
+            print(f"  Failed to save image for {brand} {name}")
+    else:
+        print(f"  Could not find suitable image for {brand} {name}")
+    return None
 
 def process_hair_recommendations(recommendations, recommendations_dir):
     """Process and save hair product recommendations with high-quality images"""
@@ -624,52 +826,38 @@ def process_hair_recommendations(recommendations, recommendations_dir):
                 types[product_type] = []
             types[product_type].append(product)
         
-        # Process each product type
+        # Display product info for each type, and number the products in order
+        jobs = []
         product_count = 1
-        successful_products = []
-        
         for product_type, products in types.items():
             if products:
                 print(f"\n{product_type.upper()}:")
                 for product in products:
-                    # Get product info
-                    brand = product.get('brand', 'Unknown')
-                    name = product.get('name', 'Unknown Product')
-                    price = product.get('price_estimate', 0)
-                    
-                    print(f"- {brand} {name} (${price})")
+                    print(f"- {product.get('brand', 'Unknown')} {product.get('name', 'Unknown Product')} (${product.get('price_estimate', 0)})")
                     print(f"  Reason: {product.get('reason', 'No reason provided')}")
-                    
-                    # Find product image
-                    image_url, product_url = find_product_image(name, brand, product_type)
-                    
-                    if image_url:
-                        # Create a unique filename with limited length
-                        filename = f"hair_rec_{product_count}_{product_type}_{brand[:20]}.png"
-                        # Remove problematic characters from filename
-                        filename = "".join(c if c.isalnum() or c in ['_', '.', '-'] else '_' for c in filename)
-                        img_path = os.path.join(recommendations_dir, filename)
-                        
-                        # Download the image and remove background
-                        if download_image(image_url, img_path):
-                            print(f"  Image saved: recommendations/{filename}")
-                            
-                            # Store successful product with URL
-                            successful_product = product.copy()
-                            successful_product['image_url'] = image_url
-                            if product_url:
-                                successful_product['product_url'] = product_url
-                            successful_products.append(successful_product)
-                        else:
-                            print(f"  Failed to save image for {brand} {name}")
-                    else:
-                        print(f"  Could not find suitable image for {brand} {name}")
-                    
-                    # Add a short delay between requests to avoid rate limiting
-                    time.sleep(random.uniform(1.0, 2.0))
-                    
+                    jobs.append((product, product_type, product_count))
                     product_count += 1
         
+        # Search, download and process the products concurrently; the work is mostly waiting
+        # on the network, and each worker still sleeps between its own requests
+        print(f"\nFinding images for {len(jobs)} products...")
+        with ThreadPoolExecutor(max_workers=min(PRODUCT_WORKERS, len(jobs))) as executor:
+            results = list(executor.map(lambda job: process_hair_product(*job, recommendations_dir), jobs))
+        downloaded = [result for result in results if result is not None]
+        
+        # Remove all the backgrounds in one batched pass
+        saved = remove_backgrounds([image_bytes for _, _, image_bytes in downloaded],
+                                   [img_path for _, img_path, _ in downloaded])
+        successful_products = []
+        for (product, img_path, _), ok in zip(downloaded, saved):
+            if ok:
+                print(f"  Image saved: recommendations/{os.path.basename(img_path)}")
+                successful_products.append(product)
+        
+        # Hand cached GPU memory back once the whole batch is done
+        if CARVEKIT_DEVICE.startswith('cuda'):
+            torch.cuda.empty_cache()
+        
         # Save recommendations data to a JSON file
         if successful_products:
             json_path = os.path.join(recommendations_dir, "recommendations.json")
@@ -684,17 +872,10 @@ def process_hair_recommendations(recommendations, recommendations_dir):
         return False
 
 def main():
-    # Create recommendations folder if it doesn't exist
+    # Start from an empty recommendations folder, clearing out any previous run
     recommendations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recommendations")
-    if not os.path.exists(recommendations_dir):
-        os.makedirs(recommendations_dir)
-        print(f"Created recommendations folder at {recommendations_dir}")
-    else:
-        # Clean existing recommendations
-        for file in os.listdir(recommendations_dir):
-            file_path = os.path.join(recommendations_dir, file)
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
+    shutil.rmtree(recommendations_dir, ignore_errors=True)
+    os.makedirs(recommendations_dir, exist_ok=True)
 
     print("\n=== Hair Type Analysis and Product Recommendations ===\n")
     
@@ -718,6 +899,14 @@ def main():
         for type_, prob in probabilities.items():
             print(f"{type_}: {prob*100:.2f}%")
     
+    # Only the interactive CLI asks for a missing key; importing the module never blocks on input
+    global GEMINI_API_KEY
+    if not GEMINI_API_KEY:
+        print("Please set your GEMINI_API_KEY environment variable")
+        print("You can get one at: https://ai.google.dev/")
+        GEMINI_API_KEY = input("Enter your Gemini API key: ").strip()
+        os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
+    
     # Get additional information
     print("\nPlease provide additional information:")
     dandruff = input("Dandruff level (None/Light/Medium/Heavy): ")
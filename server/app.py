@@ -2,20 +2,31 @@ from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image, ImageFilter, ImageOps
+import numpy as np
 from io import BytesIO
-import base64
-import tempfile
+import hashlib
 import uuid
 import sys
 import gc
+import tempfile
+import itertools
 import time
+import queue
+import threading
 import re
+import traceback
 from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+
+from data_url import make_data_url
 
 # Try to import BeautifulSoup
 try:
-    from bs4 import BeautifulSoup
+    from bs4 import BeautifulSoup, SoupStrainer
     print("Successfully imported BeautifulSoup - web scraping for hair products is available")
     BS4_AVAILABLE = True
 except ImportError:
@@ -24,6 +35,13 @@ except ImportError:
     print("Please install it with: pip install beautifulsoup4")
     BS4_AVAILABLE = False
 
+# lxml is a C parser and much faster than the pure-Python html.parser; use it when installed
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
 # Try to import carvekit for background removal
 CARVEKIT_AVAILABLE = False
 try:
@@ -33,9 +51,9 @@ try:
     # Initialize the carvekit interface with optimized settings for product images
     CARVEKIT_INTERFACE = HiInterface(
         object_type="product",       # Specifically optimized for product images
-        batch_size_seg=1,            # Process one image at a time
-        batch_size_matting=1,        # Process one image at a time
-        seg_mask_size=1024,          # Increased resolution for better detail
+        batch_size_seg=4,            # Concurrent requests are segmented together (see CarveKitBatcher)
+        batch_size_matting=1,        # Matting runs per product crop, which differ in size
+        seg_mask_size=512,           # Coarse mask only locates the product; matting refines the edges
         matting_mask_size=2048,      # High resolution matting
         trimap_prob_threshold=250,   # Higher threshold = more conservative (keeps more of product)
         trimap_dilation=5,           # Smaller dilation for finer control around edges
@@ -68,9 +86,9 @@ except ImportError:
         # Initialize the carvekit interface with optimized settings for product images
         CARVEKIT_INTERFACE = HiInterface(
             object_type="product",       # Specifically optimized for product images
-            batch_size_seg=1,            # Process one image at a time
-            batch_size_matting=1,        # Process one image at a time
-            seg_mask_size=1024,          # Increased resolution for better detail
+            batch_size_seg=4,            # Concurrent requests are segmented together (see CarveKitBatcher)
+            batch_size_matting=1,        # Matting runs per product crop, which differ in size
+            seg_mask_size=512,           # Coarse mask only locates the product; matting refines the edges
             matting_mask_size=2048,      # High resolution matting
             trimap_prob_threshold=250,   # Higher threshold = more conservative (keeps more of product)
             trimap_dilation=5,           # Smaller dilation for finer control around edges
@@ -96,6 +114,282 @@ except ImportError:
         except:
             print("Failed to install rembg fallback. Background removal will be unavailable.")
 
+# Pin torch's thread pools once so concurrent requests don't oversubscribe the CPU
+if 'CARVEKIT_INTERFACE' in globals():
+    import torch
+    torch.set_num_threads(os.cpu_count() or 1)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before any parallel work has started
+        pass
+
+def cpu_supports_bf16():
+    """Whether the CPU advertises native bfloat16 instructions (AVX-512 BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+# Run CarveKit under bfloat16 autocast on CPU. This halves weight bandwidth for the U2NET/FBA
+# convs at a small cost in matting precision, so it defaults to on only where the CPU has native
+# bf16 support; CARVEKIT_BF16=1/0 forces it either way.
+CARVEKIT_BF16 = (os.environ['CARVEKIT_BF16'] == '1') if 'CARVEKIT_BF16' in os.environ else cpu_supports_bf16()
+
+# Single worker that serializes every model inference on the shared CarveKit interface
+INFER_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# Optional ONNX Runtime export of CarveKit's U2NET segmentation model (see export_segmentation_onnx).
+# When set, segmentation runs through ORT's fused CPU kernels instead of eager PyTorch.
+CARVEKIT_SEG_ONNX_PATH = os.environ.get('CARVEKIT_SEG_ONNX_PATH')
+SEG_ONNX_SESSION = None
+
+# Normalization CarveKit's U2NET wrapper applies to its input
+U2NET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+U2NET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+def export_segmentation_onnx(output_path, quantize=True):
+    """Export CarveKit's U2NET to ONNX, plus an int8 (dynamically quantized) copy
+    
+    Use it by setting CARVEKIT_SEG_ONNX_PATH to the returned path.
+    """
+    seg_model = CARVEKIT_INTERFACE.segmentation_pipeline
+    size = seg_model.input_image_size
+    dummy = torch.zeros((1, 3, size[1], size[0]), dtype=torch.float32)
+    with torch.inference_mode():
+        torch.onnx.export(seg_model, dummy, output_path, opset_version=17,
+                          input_names=['input'], output_names=['mask'],
+                          dynamic_axes={'input': {0: 'batch'}, 'mask': {0: 'batch'}})
+    print(f"Saved segmentation model to {output_path}")
+    if not quantize:
+        return output_path
+    
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantized_path = f"{os.path.splitext(output_path)[0]}.int8.onnx"
+    quantize_dynamic(output_path, quantized_path, weight_type=QuantType.QInt8)
+    print(f"Saved quantized segmentation model to {quantized_path}")
+    return quantized_path
+
+def get_seg_onnx_session():
+    """Create the ONNX Runtime segmentation session on first use"""
+    global SEG_ONNX_SESSION
+    if SEG_ONNX_SESSION is None:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        SEG_ONNX_SESSION = ort.InferenceSession(CARVEKIT_SEG_ONNX_PATH, sess_options=options,
+                                                providers=['CPUExecutionProvider'])
+    return SEG_ONNX_SESSION
+
+def onnx_segmentation_masks(images):
+    """U2NET masks from the ONNX session, matching CarveKit's pre- and post-processing"""
+    session = get_seg_onnx_session()
+    model_input = session.get_inputs()[0]
+    height, width = model_input.shape[2], model_input.shape[3]
+    
+    batch = []
+    for img in images:
+        arr = np.asarray(img.resize((width, height), Image.BICUBIC), dtype=np.float32)
+        arr = (arr / max(float(arr.max()), 1.0) - U2NET_MEAN) / U2NET_STD
+        batch.append(arr.transpose(2, 0, 1))
+    outputs = session.run(None, {model_input.name: np.stack(batch)})[0]
+    
+    masks = []
+    for img, output in zip(images, outputs):
+        mask = output[0]
+        mask = (mask - mask.min()) / max(float(mask.max() - mask.min()), 1e-8)
+        masks.append(Image.fromarray((mask * 255).astype(np.uint8), 'L').resize(img.size, Image.BICUBIC))
+    return masks
+
+def segment_images(images):
+    """Coarse product masks, from ONNX Runtime when an exported model is configured"""
+    if CARVEKIT_SEG_ONNX_PATH:
+        return onnx_segmentation_masks(images)
+    return CARVEKIT_INTERFACE.segmentation_pipeline(images=images)
+
+# Mask values above this count as product when locating the region to matte
+MATTING_MASK_THRESHOLD = 10
+# Margin kept around the product when cropping for matting, as a fraction of the longest side
+MATTING_CROP_MARGIN = 0.05
+
+def matting_crop_box(mask):
+    """Bounding box of the product in a coarse mask, padded so the trimap band isn't clipped"""
+    bbox = mask.point(lambda v: 255 if v > MATTING_MASK_THRESHOLD else 0).getbbox()
+    if bbox is None:
+        return (0, 0) + mask.size
+    
+    margin = max(16, int(max(mask.size) * MATTING_CROP_MARGIN))
+    left, top, right, bottom = bbox
+    return (max(0, left - margin), max(0, top - margin),
+            min(mask.size[0], right + margin), min(mask.size[1], bottom + margin))
+
+def carvekit_cutout(images):
+    """Segment at low resolution, then run FBA matting only on the cropped product region"""
+    images = [img if img.mode == 'RGB' else img.convert('RGB') for img in images]
+    
+    # U2NET runs at seg_mask_size regardless of input, and returns masks at the input size
+    masks = segment_images(images)
+    
+    results = []
+    for img, mask in zip(images, masks):
+        box = matting_crop_box(mask)
+        # The post-processing pipeline builds the trimap and runs FBA, returning an RGBA cut-out
+        cutout = CARVEKIT_INTERFACE.postprocessing_pipeline(images=[img.crop(box)], masks=[mask.crop(box)])[0]
+        if box == (0, 0) + img.size:
+            results.append(cutout)
+            continue
+        
+        output = Image.new('RGBA', img.size, (0, 0, 0, 0))
+        output.paste(cutout, box[:2])
+        results.append(output)
+    return results
+
+def carvekit_inference(images):
+    """Run the CarveKit cut-out in inference mode, under bf16 autocast when enabled"""
+    global CARVEKIT_BF16
+    # inference_mode skips the autograd and tensor version-counter bookkeeping no_grad still does
+    with torch.inference_mode():
+        if CARVEKIT_BF16:
+            try:
+                # Autocast state is thread-local, so it has to be entered on the worker thread
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    return carvekit_cutout(images)
+            except RuntimeError as e:
+                # Some ops/builds lack bf16 kernels; fall back to fp32 for good
+                print(f"bf16 inference failed, falling back to fp32: {str(e)}")
+                CARVEKIT_BF16 = False
+        return carvekit_cutout(images)
+
+# Concurrent requests are coalesced into one CarveKit call of up to this many images, waiting at
+# most CARVEKIT_BATCH_WAIT seconds for the batch to fill
+CARVEKIT_BATCH_SIZE = 4
+CARVEKIT_BATCH_WAIT = 0.02
+
+class CarveKitBatcher:
+    """Micro-batch images from concurrent requests into shared CarveKit runs"""
+    
+    def __init__(self, batch_size=CARVEKIT_BATCH_SIZE, max_wait=CARVEKIT_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def submit(self, img):
+        """Queue an image and return a Future for its cut-out"""
+        with self.lock:
+            # Started lazily so it also comes up in forked gunicorn workers
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        future = Future()
+        self.queue.put((img, future))
+        return future
+    
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                # Still runs on the single inference worker, so it serializes with the warm-up
+                results = INFER_EXECUTOR.submit(carvekit_inference, [img for img, _ in batch]).result()
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+CARVEKIT_BATCHER = CarveKitBatcher()
+
+def run_carvekit(images):
+    """Run CarveKit through the request batcher and wait for the results"""
+    futures = [CARVEKIT_BATCHER.submit(img) for img in images]
+    return [future.result() for future in futures]
+
+def warm_up_carvekit():
+    """Run one synthetic image through CarveKit so the weights are paged in before real traffic"""
+    try:
+        start_time = time.time()
+        warmup_img = Image.new('RGB', (512, 512), (255, 255, 255))
+        # A solid block in the middle so both segmentation and the cropped matting stage run
+        warmup_img.paste((90, 90, 90), (128, 128, 384, 384))
+        carvekit_inference([warmup_img])
+        print(f"CarveKit warm-up completed in {time.time() - start_time:.2f} seconds")
+    except Exception as e:
+        print(f"CarveKit warm-up failed: {str(e)}")
+
+def carvekit_remove_background(img):
+    """Remove the background with CarveKit on the inference worker"""
+    # CarveKit accepts PIL images directly
+    processed_images = run_carvekit([img])
+    if not processed_images:
+        raise Exception("CarveKit returned empty result")
+    return processed_images[0]
+
+def rembg_remove_background(img):
+    """Remove the background with rembg"""
+    # Use alpha matting for better edge quality
+    return remove_bg(img, 
+                     alpha_matting=True, 
+                     alpha_matting_foreground_threshold=240,
+                     alpha_matting_background_threshold=20,
+                     alpha_matting_erode_size=15)
+
+# Background removal backends in order of preference. Everything they need is loaded at startup,
+# so falling through to the next one never builds a model on the request path.
+BACKGROUND_REMOVAL_BACKENDS = []
+if 'CARVEKIT_INTERFACE' in globals():
+    BACKGROUND_REMOVAL_BACKENDS.append(("CarveKit", carvekit_remove_background))
+if 'remove_bg' in globals():
+    BACKGROUND_REMOVAL_BACKENDS.append(("rembg", rembg_remove_background))
+
+# Reference counting frees the image buffers as soon as they're deleted; a full collection walks
+# every live object (including the model graphs), so only run one every GC_EVERY_N_REQUESTS
+# requests, off the request thread.
+GC_EVERY_N_REQUESTS = 50
+GC_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+REQUEST_COUNTER = itertools.count(1)
+
+def collect_garbage_periodically():
+    """Schedule a background gc.collect() every GC_EVERY_N_REQUESTS processed images"""
+    if next(REQUEST_COUNTER) % GC_EVERY_N_REQUESTS == 0:
+        GC_EXECUTOR.submit(gc.collect)
+
+# Queue the warm-up on the inference worker at startup; requests that arrive first just wait behind it
+if 'CARVEKIT_INTERFACE' in globals() and os.environ.get('CARVEKIT_WARMUP', '1') == '1':
+    INFER_EXECUTOR.submit(warm_up_carvekit)
+
+# Shared HTTP session so repeated downloads and page fetches from the same hosts reuse connections
+HTTP_SESSION = requests.Session()
+# Mimic a browser on every request to avoid being blocked
+HTTP_SESSION.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+HTTP_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.2))
+HTTP_SESSION.mount('https://', HTTP_ADAPTER)
+HTTP_SESSION.mount('http://', HTTP_ADAPTER)
+
+def read_response_body(response, chunk_size=65536):
+    """Read a streamed response into a BytesIO chunk by chunk"""
+    buffer = BytesIO()
+    for chunk in response.iter_content(chunk_size):
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
@@ -103,91 +397,203 @@ CORS(app)  # Enable CORS for all routes
 TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Processed images kept in TEMP_DIR double as a result cache; evict least recently used past this size
+TEMP_DIR_MAX_BYTES = int(os.environ.get('TEMP_DIR_MAX_BYTES', 512 * 1024 * 1024))
+
+# Output encodings for processed images: PIL format, mimetype and save options. WebP keeps the
+# alpha channel at a fraction of PNG's size; PNG uses fast compression since matting output
+# barely shrinks at higher levels.
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png', {'compress_level': 1}),
+    'webp': ('WEBP', 'image/webp', {'quality': 85, 'method': 4}),
+}
+
+def result_cache_key(image_url, enhance, fmt):
+    """Key a background-removal result by its source URL, preprocessing options and output format"""
+    return hashlib.sha256(f"{image_url}|enhance={enhance}|fmt={fmt}".encode()).hexdigest()
+
+def prune_temp_dir(max_bytes=TEMP_DIR_MAX_BYTES):
+    """Delete the least recently used processed images until TEMP_DIR fits in max_bytes"""
+    entries = []
+    total = 0
+    with os.scandir(TEMP_DIR) as it:
+        for entry in it:
+            # .tmp files are results still being written by another request
+            if entry.is_file(follow_symlinks=False) and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+def background_removal_result(image_id, image_path, inline, fmt='png', image_bytes=None):
+    """Build the /remove-background response for a processed image saved in TEMP_DIR"""
+    result = {
+        "success": True,
+        "url": f"/bg/{image_id}"
+    }
+    if inline:
+        # JSON clients still expect an inline data URL; reuse the encoded image instead of encoding again
+        if image_bytes is None:
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        result["base64Image"] = make_data_url(image_bytes, OUTPUT_FORMATS[fmt][1])
+    return jsonify(result)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy", "background_removal_available": CARVEKIT_AVAILABLE})
 
-def optimize_image_for_processing(img, max_size=1200):
-    """Resize image if too large for better performance"""
+# Longest side of images sent through background removal
+PROCESSING_MAX_SIZE = 1200
+PRODUCT_IMAGE_MAX_SIZE = 1500
+# Downscales first reduce with a box filter (or a JPEG draft decode) to within this factor of the
+# target, then finish with LANCZOS
+RESIZE_REDUCING_GAP = 3.0
+
+def load_image_for_processing(img):
+    """Decode an opened image once, at reduced scale where possible, and drop its metadata"""
+    # Let libjpeg decode large JPEGs at a reduced scale before we force the load
+    draft_size = int(PROCESSING_MAX_SIZE * RESIZE_REDUCING_GAP)
+    img.draft('RGB', (draft_size, draft_size))
+    img.load()
+    
+    # EXIF and ICC blobs (often tens of KB) would otherwise ride along through every copy and
+    # could be re-embedded by the PNG/WebP encoders; the cut-out never needs them
+    img.info.pop('exif', None)
+    img.info.pop('icc_profile', None)
+    return img
+
+def optimize_image_for_processing(img, max_size=PROCESSING_MAX_SIZE, enhance=False):
+    """Resize image if too large for better performance, optionally boosting product edges"""
     if max(img.size) > max_size:
-        # Calculate new dimensions while maintaining aspect ratio
-        ratio = max_size / max(img.size)
-        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-        
-        # Use LANCZOS for best quality downsampling
-        img = img.resize(new_size, Image.LANCZOS)
-        print(f"Resized image to {new_size} for better processing")
+        # thumbnail keeps the aspect ratio and, with reducing_gap, does a cheap box reduction
+        # (or JPEG draft decode) to near the target before the final LANCZOS pass
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        print(f"Resized image to {img.size} for better processing")
     
     # Convert to RGB if needed (remove alpha channel if present)
     if img.mode == 'RGBA':
         # Create white background
         background = Image.new('RGB', img.size, (255, 255, 255))
-        # Paste image with alpha channel onto white background
-        background.paste(img, mask=img.split()[3])
+        # Paste image onto white background; an RGBA mask uses its alpha band directly,
+        # so there is no need to split out all four bands first
+        background.paste(img, mask=img)
         img = background
         print("Converted RGBA image to RGB for better compatibility")
     elif img.mode != 'RGB':
         img = img.convert('RGB')
         print(f"Converted {img.mode} image to RGB for better compatibility")
     
-    # Enhance the image to make product edges clearer
-    from PIL import ImageEnhance
+    # CarveKit's models are trained on unenhanced images and the boosts harden soft hair
+    # edges for matting, so only enhance when the caller asks for it
+    if enhance:
+        img = enhance_product_edges(img)
     
-    # Slightly increase brightness to better separate product
-    enhancer = ImageEnhance.Brightness(img)
-    img = enhancer.enhance(1.05)
-    
-    # Increase contrast moderately to help with edge detection
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(1.25)  # Increased contrast for better segmentation
+    return img
+
+# Enhancement factors applied before segmentation
+ENHANCE_BRIGHTNESS = 1.05  # Slightly increase brightness to better separate product
+ENHANCE_CONTRAST = 1.25    # Increased contrast for better segmentation
+ENHANCE_SHARPNESS = 1.8    # Increased sharpness for clearer edges
+
+def enhance_product_edges(img):
+    """Apply the brightness, contrast and sharpness boosts with as few full-image passes as possible"""
+    # Brightness and contrast are both affine (factor * I + (1 - factor) * degenerate), so they
+    # compose into one lookup table; contrast pulls towards the mean luminance of the brightened image
+    histogram = img.convert('L').histogram()
+    total = sum(histogram) or 1
+    mean = sum(count * min(255, value * ENHANCE_BRIGHTNESS) for value, count in enumerate(histogram)) / total
+    mean = int(mean + 0.5)
     
-    # Sharpen image to improve edge detection
-    enhancer = ImageEnhance.Sharpness(img)
-    img = enhancer.enhance(1.8)  # Increased sharpness for clearer edges
+    lut = [
+        max(0, min(255, int(ENHANCE_CONTRAST * min(255, int(value * ENHANCE_BRIGHTNESS)) + (1 - ENHANCE_CONTRAST) * mean + 0.5)))
+        for value in range(256)
+    ]
+    img = img.point(lut * len(img.getbands()))
     
-    return img
+    # Sharpness blends away from the SMOOTH-filtered image, exactly like ImageEnhance.Sharpness
+    return Image.blend(img.filter(ImageFilter.SMOOTH), img, ENHANCE_SHARPNESS)
 
 @app.route('/remove-background', methods=['POST'])
 def remove_background():
     if not CARVEKIT_AVAILABLE:
         return jsonify({"error": "Background removal is not available"}), 500
     
-    data = request.json
-    if not data or 'imageUrl' not in data:
-        return jsonify({"error": "No image URL provided"}), 400
+    # Multipart uploads are streamed by Werkzeug, so prefer them over downloading a URL
+    upload = request.files.get('image')
+    if upload:
+        print(f"Processing uploaded image: {upload.filename}")
+    else:
+        data = request.get_json(silent=True)
+        if not data or 'imageUrl' not in data:
+            return jsonify({"error": "No image URL or image upload provided"}), 400
+        
+        image_url = data['imageUrl']
+        print(f"Processing image URL: {image_url}")
+    
+    # ?enhance=1 re-enables the edge boosts before segmentation
+    enhance = request.args.get('enhance') == '1'
     
-    image_url = data['imageUrl']
-    print(f"Processing image URL: {image_url}")
+    # ?fmt=webp returns a much smaller WebP (with alpha) instead of PNG
+    fmt = request.args.get('fmt', 'png').lower()
+    if fmt not in OUTPUT_FORMATS:
+        return jsonify({"error": f"Unsupported output format: {fmt}"}), 400
+    
+    if not upload:
+        # Skip the download and the whole pipeline for URLs we've already processed
+        cache_key = result_cache_key(image_url, enhance, fmt)
+        cached_path = os.path.join(TEMP_DIR, f"{cache_key}.{fmt}")
+        if os.path.exists(cached_path):
+            try:
+                # Bump the mtime so eviction treats this as recently used
+                os.utime(cached_path)
+                response = background_removal_result(cache_key, cached_path, inline=True, fmt=fmt)
+                print(f"Using cached background removal result: {cached_path}")
+                return response
+            except FileNotFoundError:
+                # Evicted by another request's prune since the exists() check; process it again
+                print(f"Cached result disappeared, processing again: {cached_path}")
     
     try:
-        # Download the image with a longer timeout
-        response = requests.get(image_url, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }, timeout=20)
-        response.raise_for_status()
-        
-        # Check if response is an image
-        content_type = response.headers.get('Content-Type', '')
-        print(f"Content type: {content_type}")
-        
-        if 'image' not in content_type:
-            # Sometimes content type can be wrong or missing, try to load as image anyway
+        if upload:
             try:
-                image_data = BytesIO(response.content)
-                Image.open(image_data)
-                print("Successfully opened image despite content type mismatch")
-                # If it opens as an image, proceed anyway
+                img = load_image_for_processing(Image.open(upload.stream))
+            except Exception as img_error:
+                print(f"Failed to open upload as image: {str(img_error)}")
+                return jsonify({"error": "Uploaded file is not an image"}), 400
+        else:
+            # Download the image with a longer timeout, streaming it over a pooled connection.
+            # Images are already compressed, so ask the host not to gzip them again.
+            response = HTTP_SESSION.get(image_url, headers={'Accept-Encoding': 'identity'}, timeout=20, stream=True)
+            response.raise_for_status()
+            image_data = read_response_body(response)
+            
+            # Check if response is an image
+            content_type = response.headers.get('Content-Type', '')
+            print(f"Content type: {content_type}")
+            
+            # Load image from response content. PIL identifies the format from the magic bytes, so
+            # this also sniffs responses whose content type is wrong or missing.
+            try:
+                img = load_image_for_processing(Image.open(image_data))
             except Exception as img_error:
                 print(f"Failed to open as image: {str(img_error)}")
                 return jsonify({"error": f"URL does not point to an image: {content_type}"}), 400
-        
-        # Load image from response content
-        image_data = BytesIO(response.content)
-        img = Image.open(image_data)
+            
+            if 'image' not in content_type:
+                print("Successfully opened image despite content type mismatch")
         print(f"Image loaded successfully: {img.format} {img.mode} {img.size}")
         
         # Optimize image before processing
-        img = optimize_image_for_processing(img)
+        img = optimize_image_for_processing(img, enhance=enhance)
         
         # Record processing start time
         start_time = time.time()
@@ -195,93 +601,26 @@ def remove_background():
         # Remove background using available method
         print(f"Removing background from image...")
         try:
-            # Save to temp file if needed (some models require file path)
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                img.save(tmp.name)
-                tmp_path = tmp.name
-                print(f"Saved input image to temporary file: {tmp_path}")
-            
             output_img = None
             
-            # First try: Process with carvekit through file path if available
-            if 'CARVEKIT_INTERFACE' in globals():
+            if not BACKGROUND_REMOVAL_BACKENDS:
+                return jsonify({"error": "No background removal method available"}), 500
+            
+            # Try each backend in order until one produces an image
+            backend_error = None
+            for backend_name, remove_background_with in BACKGROUND_REMOVAL_BACKENDS:
                 try:
-                    print("Processing with CarveKit...")
-                    # Process with CarveKit through file path
-                    processed_images = CARVEKIT_INTERFACE([tmp_path])
-                    
-                    if processed_images and len(processed_images) > 0:
-                        # Get the result
-                        output_img = processed_images[0]
-                        
-                        # Free memory
-                        del processed_images
-                        gc.collect()
-                        print(f"CarveKit processing completed in {time.time() - start_time:.2f} seconds")
-                    else:
-                        raise Exception("CarveKit returned empty result")
-                
+                    print(f"Processing with {backend_name}...")
+                    output_img = remove_background_with(img)
+                    print(f"{backend_name} processing completed in {time.time() - start_time:.2f} seconds")
+                    break
                 except Exception as e:
-                    print(f"First CarveKit method failed: {str(e)}")
-                    
-                    # Try alternative approach with direct processing
-                    try:
-                        print("Trying alternative CarveKit approach...")
-                        output_img = CARVEKIT_INTERFACE.process_image(img)
-                        print(f"Alternative CarveKit processing completed in {time.time() - start_time:.2f} seconds")
-                    except Exception as e2:
-                        print(f"Alternative CarveKit approach failed: {str(e2)}")
-                        
-                        # Try one more option with alpha matting if previous attempts failed
-                        try:
-                            print("Trying direct processing with custom settings...")
-                            from carvekit.api.interface import Interface
-                            from carvekit.ml.wrap.u2net import U2NET
-                            from carvekit.trimap.generator import TrimapGenerator
-                            from carvekit.ml.wrap.fba_matting import FBAMatting
-                            
-                            # Custom segmentation model
-                            seg_model = U2NET(device='cpu', batch_size=1)
-                            # Custom trimap generator
-                            trimap_generator = TrimapGenerator(prob_threshold=230, 
-                                                             kernel_size=15, 
-                                                             erosion_iters=3)
-                            # Custom matting model
-                            matting_model = FBAMatting(device='cpu', batch_size=1, 
-                                                     input_tensor_size=2048,
-                                                     ram_efficient=True)
-                            
-                            # Create a custom interface with our tuned parameters
-                            interface = Interface(seg_model, matting_model, trimap_generator)
-                            
-                            # Process the image with our custom interface
-                            output_img = interface.process_image(img)
-                            print(f"Custom processing completed in {time.time() - start_time:.2f} seconds")
-                        except Exception as e3:
-                            print(f"Custom processing approach failed: {str(e3)}")
-                            raise e2
+                    print(f"{backend_name} processing failed: {str(e)}")
+                    backend_error = e
             
-            # Second try: Use rembg if available
-            elif 'remove_bg' in globals():
-                print("Using rembg for background removal...")
-                # Use alpha matting for better edge quality
-                output_img = remove_bg(img, 
-                                      alpha_matting=True, 
-                                      alpha_matting_foreground_threshold=240,
-                                      alpha_matting_background_threshold=20,
-                                      alpha_matting_erode_size=15)
-                print(f"Rembg processing completed in {time.time() - start_time:.2f} seconds")
+            if output_img is None and backend_error is not None:
+                return jsonify({"error": f"Background removal is temporarily unavailable: {str(backend_error)}"}), 503
             
-            else:
-                # Clean up temp file
-                if os.path.exists(tmp_path):
-                    os.unlink(tmp_path)
-                return jsonify({"error": "No background removal method available"}), 500
-            
-            # Clean up temp file
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-                
             if output_img is None:
                 return jsonify({"error": "Background removal failed - no output image generated"}), 500
             
@@ -290,28 +629,37 @@ def remove_background():
             
             print("Background removal successful")
             
-            # Save the processed image to a temporary file
-            unique_id = str(uuid.uuid4())
-            temp_file_path = os.path.join(TEMP_DIR, f"{unique_id}.png")
-            output_img.save(temp_file_path, format="PNG")
+            # Save the processed image to a temporary file; URL results are saved under their
+            # cache key so repeat requests can be served straight from disk
+            unique_id = str(uuid.uuid4()) if upload else cache_key
+            image_format, _, save_options = OUTPUT_FORMATS[fmt]
+            temp_file_path = os.path.join(TEMP_DIR, f"{unique_id}.{fmt}")
+            # Encode once and reuse the bytes for both the temp file and the inline data URL
+            with BytesIO() as buffered:
+                output_img.save(buffered, format=image_format, **save_options)
+                image_bytes = buffered.getvalue()
+            # Write to a temporary name first so cache hits and /bg never see a partial file
+            fd, partial_path = tempfile.mkstemp(dir=TEMP_DIR, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(partial_path, temp_file_path)
+            except OSError:
+                os.unlink(partial_path)
+                raise
             print(f"Saved output image to {temp_file_path}")
             
-            # Convert to base64 for response
-            buffered = BytesIO()
-            output_img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            
             # Free memory
             del output_img
             del img
-            gc.collect()
+            collect_garbage_periodically()
             
             print(f"Total processing time: {time.time() - start_time:.2f} seconds")
             
-            return jsonify({
-                "success": True,
-                "base64Image": f"data:image/png;base64,{img_str}"
-            })
+            prune_temp_dir()
+            
+            return background_removal_result(unique_id, temp_file_path, inline=not upload, fmt=fmt,
+                                             image_bytes=image_bytes)
         
         except Exception as proc_error:
             print(f"Background removal failed: {str(proc_error)}")
@@ -321,26 +669,41 @@ def remove_background():
         print(f"Error processing image: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/bg/<image_id>', methods=['GET'])
+def get_processed_image(image_id):
+    """Serve a background-removed image saved by /remove-background"""
+    # Only accept ids we generated (uuids and sha256 cache keys) so the path can't escape TEMP_DIR
+    if not re.fullmatch(r'[0-9a-f-]{32,64}', image_id):
+        return jsonify({"error": "Invalid image id"}), 400
+    
+    for fmt, (_, mimetype, _) in OUTPUT_FORMATS.items():
+        image_path = os.path.join(TEMP_DIR, f"{image_id}.{fmt}")
+        if os.path.exists(image_path):
+            return send_file(image_path, mimetype=mimetype, conditional=True)
+    
+    return jsonify({"error": "Image not found"}), 404
+
+# Alpha clean-up: a very light feather to remove noise, then a 1% autocontrast stretch.
+# The 3x3 kernel matches GaussianBlur(radius=0.3) to within 2 levels at half the cost, since
+# PIL's Gaussian runs several box-blur passes even for tiny radii.
+ALPHA_FEATHER_KERNEL = ImageFilter.Kernel((3, 3), [0, 10, 0, 10, 213, 10, 0, 10, 0], scale=253)
+ALPHA_CUTOFF_PERCENT = 1
+
 # Post-processing for cleaned up edges
 def post_process_alpha(output_img):
     """Apply post-processing to improve alpha channel quality"""
     if output_img.mode == 'RGBA':
-        # Split channels
-        r, g, b, a = output_img.split()
-        
-        # Clean up the alpha channel
-        from PIL import ImageFilter
+        # Only the alpha band changes, so there's no need to split out and re-merge the colour bands
+        a = output_img.getchannel('A')
         
-        # Remove noise in the alpha channel with a slight blur
-        a = a.filter(ImageFilter.GaussianBlur(radius=0.3))
+        # Remove noise in the alpha channel with a slight feather
+        a = a.filter(ALPHA_FEATHER_KERNEL)
         
-        # Apply a threshold to make edges cleaner
-        from PIL import ImageOps
-        a = ImageOps.autocontrast(a, cutoff=1)
+        # Apply a threshold to make edges cleaner (a histogram plus one lookup-table pass in C)
+        a = ImageOps.autocontrast(a, cutoff=ALPHA_CUTOFF_PERCENT)
         
-        # Reassemble the image
-        processed_img = Image.merge('RGBA', (r, g, b, a))
-        return processed_img
+        output_img.putalpha(a)
+        return output_img
     
     return output_img
 
@@ -373,18 +736,25 @@ def search_hair_product():
         
         print(f"Searching for hair product: {brand} {product_name}")
         
-        # First try LookFantastic
-        product_url = search_product_on_lookfantastic(product_name, brand)
-        image_url = None
-        
-        if product_url:
-            # Extract the product image from the page
-            image_url = get_product_image_from_lookfantastic(product_url)
-        
-        # If LookFantastic doesn't have it, try Google
-        if not image_url:
-            image_url = search_product_on_google(product_name, brand, product_type)
-            product_url = None  # We don't have a product URL from Google search
+        cache_key = (brand.strip().lower(), product_name.strip().lower(), product_type.strip().lower())
+        cached = PRODUCT_SEARCH_CACHE.get(cache_key)
+        if cached:
+            image_url, product_url = cached
+        else:
+            # Search LookFantastic and Google at the same time; LookFantastic is preferred because it
+            # also gives us a product URL, so Google's answer is only used when it comes up empty
+            lookfantastic_future = SEARCH_EXECUTOR.submit(find_lookfantastic_image, product_name, brand)
+            google_future = SEARCH_EXECUTOR.submit(search_product_on_google, product_name, brand, product_type)
+            
+            image_url, product_url = lookfantastic_future.result()
+            if image_url:
+                google_future.cancel()
+            else:
+                image_url = google_future.result()
+                product_url = None  # We don't have a product URL from Google search
+            
+            if image_url:
+                PRODUCT_SEARCH_CACHE.set(cache_key, (image_url, product_url))
             
         if image_url:
             print(f"Found hair product image: {image_url}")
@@ -403,7 +773,6 @@ def search_hair_product():
             
     except Exception as e:
         print(f"Error searching for hair product: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
@@ -450,10 +819,69 @@ def process_hair_product_image():
             
     except Exception as e:
         print(f"Error processing hair product image: {str(e)}")
-        import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+# Image URLs embedded in a Google image search results page
+GOOGLE_IMAGE_URL_RE = re.compile(r'https://[^"\']+\.(?:jpg|jpeg|png|webp)')
+# Google results that are thumbnails, icons or Google's own UI images
+GOOGLE_SKIP_URL_RE = re.compile(r'icon|thumb|small|google\.com', re.IGNORECASE)
+# imageUrl fields in the JSON data embedded in LookFantastic product pages
+LOOKFANTASTIC_JSON_IMAGE_RE = re.compile(r'"imageUrl"\s*:\s*"(https:[^"]+)"')
+# LookFantastic thumbnails and UI elements
+LOOKFANTASTIC_SKIP_URL_RE = re.compile(r'icon|thumb|logo', re.IGNORECASE)
+# URLs whose path ends in an image extension, optionally followed by a query string
+IMAGE_EXTENSION_RE = re.compile(r'\.(?:jpg|jpeg|png|webp)(?:\?|$)', re.IGNORECASE)
+# Product tiles on a LookFantastic listing page; only these subtrees are parsed from search results
+LOOKFANTASTIC_PRODUCT_STRAINER = SoupStrainer(attrs={'class': re.compile(r'^product(?:Block|Item)$')}) if BS4_AVAILABLE else None
+
+# Worker threads for the product searches, shared across requests so a slow Google lookup that
+# isn't needed doesn't hold up the response
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire ttl seconds after they're stored"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+# The same products get looked up again and again, so remember what we found for an hour.
+# Only successful lookups are cached; a miss or a failed background removal is retried next time.
+# Processed images are data URLs of a few MB each, so that cache is kept much smaller.
+PRODUCT_SEARCH_CACHE = TTLCache(maxsize=2048, ttl=3600)
+PRODUCT_IMAGE_CACHE = TTLCache(maxsize=64, ttl=3600)
+
+def find_lookfantastic_image(product_name, brand):
+    """Search LookFantastic and extract the product image, returning (image_url, product_url)"""
+    product_url = search_product_on_lookfantastic(product_name, brand)
+    if not product_url:
+        return None, None
+    
+    # Extract the product image from the page
+    return get_product_image_from_lookfantastic(product_url), product_url
+
 # Function to search for a product on LookFantastic
 def search_product_on_lookfantastic(product_name, brand):
     """Search for a product on LookFantastic and return the product URL"""
@@ -464,9 +892,8 @@ def search_product_on_lookfantastic(product_name, brand):
         search_query = f"{brand} {product_name}"
         search_url = f"https://www.lookfantastic.com/search?q={quote_plus(search_query)}"
         
-        # Create headers to mimic a browser
+        # Create headers to mimic a browser (the session sends the User-Agent)
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
             'Referer': 'https://www.lookfantastic.com/',
@@ -476,14 +903,14 @@ def search_product_on_lookfantastic(product_name, brand):
         }
         
         # Send the request
-        response = requests.get(search_url, headers=headers, timeout=10)
+        response = HTTP_SESSION.get(search_url, headers=headers, timeout=10)
         
         if response.status_code != 200:
             print(f"Failed to search LookFantastic: {response.status_code}")
             return None
         
-        # Parse the HTML with BeautifulSoup (exactly like internet.py)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # Parse only the product blocks out of the listing page; the rest of the DOM is never built
+        soup = BeautifulSoup(response.text, HTML_PARSER, parse_only=LOOKFANTASTIC_PRODUCT_STRAINER)
         
         # Find product links
         product_links = []
@@ -494,7 +921,8 @@ def search_product_on_lookfantastic(product_name, brand):
             product_elements = soup.select('.productItem')
         
         if not product_elements:
-            # Try another alternative selector
+            # Try another alternative selector; this one needs the full page
+            soup = BeautifulSoup(response.text, HTML_PARSER)
             product_elements = soup.select('[data-bind*="product"]')
         
         for product in product_elements:
@@ -515,7 +943,6 @@ def search_product_on_lookfantastic(product_name, brand):
     
     except Exception as e:
         print(f"Error searching for product: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
@@ -523,16 +950,14 @@ def search_product_on_lookfantastic(product_name, brand):
 def search_product_on_google(product_name, brand, product_type=""):
     """Search for a product image using Google"""
     try:
-        print(f"LookFantastic search failed, trying Google...")
         print(f"Searching for {brand} {product_name} image on Google...")
         
         # Format the search query to explicitly look for product images
         search_query = f"{brand} {product_name} {product_type} product image"
         search_url = f"https://www.google.com/search?q={quote_plus(search_query)}&tbm=isch"
         
-        # Create headers to mimic a browser
+        # Create headers to mimic a browser (the session sends the User-Agent)
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
             'Referer': 'https://www.google.com/',
@@ -542,7 +967,7 @@ def search_product_on_google(product_name, brand, product_type=""):
         }
         
         # Send the request
-        response = requests.get(search_url, headers=headers, timeout=10)
+        response = HTTP_SESSION.get(search_url, headers=headers, timeout=10)
         
         if response.status_code != 200:
             print(f"Failed to search Google: {response.status_code}")
@@ -552,16 +977,12 @@ def search_product_on_google(product_name, brand, product_type=""):
         image_urls = []
         
         # Extract image URLs using regex pattern matching (more reliable than parsing)
-        pattern = r'https://[^"\']+\.(?:jpg|jpeg|png|webp)'
-        matches = re.findall(pattern, response.text)
-        
+        # (finditer scans lazily, so the scan stops as soon as enough images are found)
         # Filter out low-quality and thumbnail images
-        for url in matches:
-            # Skip small thumbnails and icons
-            if 'icon' in url.lower() or 'thumb' in url.lower() or 'small' in url.lower():
-                continue
-            # Skip Google UI images
-            if 'google.com' in url:
+        for match in GOOGLE_IMAGE_URL_RE.finditer(response.text):
+            url = match.group(0)
+            # Skip small thumbnails, icons and Google UI images
+            if GOOGLE_SKIP_URL_RE.search(url):
                 continue
             # Keep only product-looking images
             image_urls.append(url)
@@ -578,7 +999,6 @@ def search_product_on_google(product_name, brand, product_type=""):
     
     except Exception as e:
         print(f"Error searching Google for product image: {str(e)}")
-        import traceback
         traceback.print_exc()
         return None
 
@@ -588,9 +1008,8 @@ def get_product_image_from_lookfantastic(product_url):
     try:
         print(f"Extracting image from {product_url}...")
         
-        # Create headers to mimic a browser
+        # Create headers to mimic a browser (the session sends the User-Agent)
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.5',
             'DNT': '1',
@@ -599,14 +1018,14 @@ def get_product_image_from_lookfantastic(product_url):
         }
         
         # Send the request
-        response = requests.get(product_url, headers=headers, timeout=10)
+        response = HTTP_SESSION.get(product_url, headers=headers, timeout=10)
         
         if response.status_code != 200:
             print(f"Failed to access product page: {response.status_code}")
             return None
         
         # Parse HTML with BeautifulSoup (exactly like internet.py)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(response.text, HTML_PARSER)
         
         # Try multiple selectors for product images
         img_urls = []
@@ -629,9 +1048,7 @@ def get_product_image_from_lookfantastic(product_url):
                 img_urls.append(img['src'])
         
         # Extract image URLs from JSON data in the page
-        json_pattern = r'"imageUrl"\s*:\s*"(https:[^"]+)"'
-        json_matches = re.findall(json_pattern, response.text)
-        img_urls.extend(json_matches)
+        img_urls.extend(LOOKFANTASTIC_JSON_IMAGE_RE.findall(response.text))
         
         # Filter out non-product images and duplicates
         filtered_urls = []
@@ -643,12 +1060,8 @@ def get_product_image_from_lookfantastic(product_url):
                 continue
             seen.add(url)
             
-            # Skip small thumbnails and UI elements
-            if 'icon' in url.lower() or 'thumb' in url.lower() or 'logo' in url.lower():
-                continue
-            
-            # Skip non-image URLs
-            if not any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
+            # Skip small thumbnails and UI elements, and non-image URLs
+            if LOOKFANTASTIC_SKIP_URL_RE.search(url) or not IMAGE_EXTENSION_RE.search(url):
                 continue
                 
             filtered_urls.append(url)
@@ -662,10 +1075,46 @@ def get_product_image_from_lookfantastic(product_url):
     
     except Exception as e:
         print(f"Error extracting product image: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
+def png_data_url(img):
+    """Encode an image as a base64 PNG data URL without copying the encoded bytes"""
+    with BytesIO() as buffered:
+        img.save(buffered, format="PNG", compress_level=1)
+        # Encode straight from the buffer; the view must be released before the BytesIO closes
+        with buffered.getbuffer() as png_bytes:
+            return make_data_url(png_bytes, 'image/png')
+
+def open_product_image(image_data, max_size=PRODUCT_IMAGE_MAX_SIZE):
+    """Open a downloaded product image, shrinking it to max_size as it's decoded"""
+    img = Image.open(image_data)
+    
+    # Check image quality and size
+    # Resize if too large for better processing; both CarveKit and rembg scale with pixel count
+    if max(img.size) > max_size:
+        # Box-reduce (or draft-decode JPEGs) close to the target before LANCZOS
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+        print(f"Resized image to {img.size} for better processing")
+    return img
+
+# Formats every browser displays as-is, by their leading magic bytes
+PASSTHROUGH_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+)
+
+def original_image_data_url(image_data):
+    """Data URL for downloaded image bytes, passing PNGs and JPEGs through without re-encoding"""
+    with image_data.getbuffer() as raw:
+        for signature, mimetype in PASSTHROUGH_IMAGE_SIGNATURES:
+            if raw[:len(signature)] == signature:
+                return make_data_url(raw, mimetype)
+    
+    # Anything else is decoded and re-encoded as PNG
+    image_data.seek(0)
+    return png_data_url(Image.open(image_data))
+
 # Function to download and remove background from a product image
 def download_and_process_product_image(image_url):
     """Download an image and remove the background"""
@@ -674,112 +1123,97 @@ def download_and_process_product_image(image_url):
         if "placeholder.com" in image_url:
             print(f"Skipping placeholder image")
             return None
+        
+        # Serve repeat requests without downloading or running background removal again
+        cached = PRODUCT_IMAGE_CACHE.get(image_url)
+        if cached:
+            print(f"Using cached processed image for {image_url}")
+            return cached
             
-        # Create a request with a User-Agent header to avoid being blocked
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+        # Images are already compressed, so ask the host not to gzip them again
+        headers = {'Accept-Encoding': 'identity'}
         
-        # Direct download for image URLs
-        response = requests.get(image_url, headers=headers, timeout=10)
+        # Direct download for image URLs, streamed over a pooled connection
+        response = HTTP_SESSION.get(image_url, headers=headers, timeout=10, stream=True)
         
         # Check if response is successful
         if response.status_code != 200:
             print(f"Failed to download image: {response.status_code}")
+            response.close()
             return None
             
         # Check if response is an image
         content_type = response.headers.get('Content-Type', '')
         if 'image' in content_type:
-            # Load image from response content
-            image_data = BytesIO(response.content)
+            # Read the body in chunks straight into the buffer PIL decodes from
+            image_data = read_response_body(response)
             
             try:
+                # Load the image once, already resized, for whichever method runs
+                img = open_product_image(image_data)
+                
                 # First try carvekit if available
                 if CARVEKIT_AVAILABLE and 'CARVEKIT_INTERFACE' in globals():
                     print(f"Removing background with CarveKit...")
                     
-                    # Load the image
-                    img = Image.open(image_data)
-                    
-                    # Check image quality and size
-                    # Resize if too large for better processing
-                    max_size = 1500
-                    if max(img.size) > max_size:
-                        ratio = max_size / max(img.size)
-                        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
-                        img = img.resize(new_size, Image.LANCZOS)
-                        print(f"Resized image to {new_size} for better processing")
-                    
-                    # Save to temp file (carvekit requires file path)
-                    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                        img.save(tmp.name)
-                        tmp_path = tmp.name
-                    
-                    # Process with CarveKit
-                    processed_images = CARVEKIT_INTERFACE([tmp_path])
+                    # Process with CarveKit on the inference worker; it accepts PIL images directly
+                    processed_images = run_carvekit([img])
                     
                     if processed_images and len(processed_images) > 0:
                         # Get the result
                         result = processed_images[0]
                         
                         # Convert to base64
-                        buffered = BytesIO()
-                        result.save(buffered, format="PNG")
-                        img_str = base64.b64encode(buffered.getvalue()).decode()
-                        
-                        # Clean up temp file
-                        os.unlink(tmp_path)
+                        data_url = png_data_url(result)
                         
                         # Free memory
                         del processed_images
-                        gc.collect()
+                        collect_garbage_periodically()
                         
                         print(f"Background removed successfully with CarveKit")
-                        return f"data:image/png;base64,{img_str}"
+                        PRODUCT_IMAGE_CACHE.set(image_url, data_url)
+                        return data_url
                 
                 # Try rembg if available
                 try:
                     from rembg import remove as remove_bg
                     print("Using rembg for background removal...")
                     
-                    # Load the image
-                    img = Image.open(image_data)
-                    
                     # Process with rembg
                     output = remove_bg(img, alpha_matting=True, alpha_matting_foreground_threshold=240)
                     
-                    # Convert to base64
-                    buffered = BytesIO()
-                    output.save(buffered, format="PNG")
-                    img_str = base64.b64encode(buffered.getvalue()).decode()
-                    
                     print(f"Background removed successfully with rembg")
-                    return f"data:image/png;base64,{img_str}"
+                    data_url = png_data_url(output)
+                    PRODUCT_IMAGE_CACHE.set(image_url, data_url)
+                    return data_url
                 except ImportError:
                     print("No background removal libraries available. Saving original image.")
             
             except Exception as e:
                 print(f"Error with background removal: {e}")
-                import traceback
                 traceback.print_exc()
             
             # If all background removal methods fail, return original image
-            img = Image.open(image_data)
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
             print(f"Returning original image without background removal")
-            return f"data:image/png;base64,{img_str}"
+            return original_image_data_url(image_data)
         else:
             print(f"URL does not point to an image: {content_type}")
+            response.close()
             return None
     except Exception as e:
         print(f"Error downloading image from {image_url}: {str(e)}")
-        import traceback
         traceback.print_exc()
         return None
 
 if __name__ == '__main__':
+    # python app.py --export-seg-onnx models/u2net.onnx writes the ONNX segmentation model and exits
+    if len(sys.argv) == 3 and sys.argv[1] == '--export-seg-onnx':
+        export_segmentation_onnx(sys.argv[2])
+        sys.exit(0)
+    
     # Use port 5001 instead of 5000 to avoid conflict with AirPlay on macOS
     port = 5001
-    # Run the app with threading enabled
-    app.run(host='0.0.0.0', port=port, debug=True, threaded=True) 
\ No newline at end of file
+    # Run the app with threading enabled; the debugger and reloader are only for development
+    # (production should run under gunicorn with gunicorn_conf.py)
+    debug = os.environ.get('FLASK_ENV') == 'development'
+    app.run(host='0.0.0.0', port=port, debug=debug, threaded=True) 
\ No newline at end of file
@@ -0,0 +1,15 @@
+# pybase64 encodes with SIMD, an order of magnitude faster than the stdlib for multi-MB images;
+# it's a drop-in replacement, so fall back to the stdlib when it isn't installed
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+def make_data_url(data, mimetype):
+    """Build a base64 data URL from bytes or a buffer view"""
+    # pybase64 can encode straight to str, skipping the bytes object and the .decode() copy
+    if hasattr(base64, 'b64encode_as_string'):
+        encoded = base64.b64encode_as_string(data)
+    else:
+        encoded = base64.b64encode(data).decode('ascii')
+    return f"data:{mimetype};base64,{encoded}"
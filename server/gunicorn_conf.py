@@ -0,0 +1,38 @@
+# Gunicorn settings for the background removal server: gunicorn -c gunicorn_conf.py app:app
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+bind = "0.0.0.0:5001"
+
+# One process holds the CarveKit models by default; requests share them across threads and
+# inference is serialized on the app's own worker thread anyway. On machines with spare cores,
+# GUNICORN_WORKERS=N runs N inference lanes that share the preloaded weights and split the
+# torch thread budget between them.
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = 4
+
+# Load the app (and the model weights) once in the master so forked workers share them copy-on-write
+preload_app = True
+
+# Background removal can take a while on CPU
+timeout = 120
+
+# Threads don't survive fork, so warm up in the worker instead of the master
+os.environ.setdefault('CARVEKIT_WARMUP', '0')
+
+def post_fork(server, worker):
+    """Give each worker its own executor threads and warm up CarveKit there"""
+    app_module = sys.modules.get('app')
+    if app_module is None:
+        return
+    
+    if workers > 1 and hasattr(app_module, 'torch'):
+        # Each worker gets its share of the cores so N workers don't oversubscribe the CPU
+        app_module.torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    
+    app_module.INFER_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    app_module.GC_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    if hasattr(app_module, 'CARVEKIT_INTERFACE'):
+        app_module.INFER_EXECUTOR.submit(app_module.warm_up_carvekit)
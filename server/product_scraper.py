@@ -1,42 +1,179 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-from urllib.parse import quote_plus
-from bs4 import BeautifulSoup
+from urllib.parse import quote_plus, unquote
+from bs4 import BeautifulSoup, SoupStrainer
 import os
+import hashlib
+import tempfile
+import threading
 import traceback
-import base64
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from functools import lru_cache, wraps
 from PIL import Image
 
+from data_url import make_data_url
+
+# rembg is optional; install it with the server requirements rather than at request time
+try:
+    from rembg import new_session, remove as rembg_remove
+except ImportError:
+    print("rembg not installed. Product images will be returned without background removal.")
+    rembg_remove = None
+
+# ONNX Runtime providers for rembg, fastest first
+REMBG_PROVIDERS = ['CUDAExecutionProvider', 'CoreMLExecutionProvider', 'CPUExecutionProvider']
+
+def create_rembg_session(model_name='u2net'):
+    """Load the rembg model on the best available provider"""
+    try:
+        # rembg drops any provider this onnxruntime build doesn't have
+        session = new_session(model_name, providers=REMBG_PROVIDERS)
+    except Exception as e:
+        # Without one, rembg falls back to loading a default session on every call
+        print(f"Could not create a shared rembg session: {e}")
+        return None
+    
+    # Diagnostics only; inner_session isn't there in every rembg version
+    try:
+        provider = session.inner_session.get_providers()[0]
+    except Exception:
+        provider = "an unknown provider"
+    print(f"rembg session ready on {provider}")
+    return session
+
+# Created on first use, so importing this module doesn't load (or download) the model
+REMBG_SESSION = None
+REMBG_SESSION_LOADED = False
+REMBG_SESSION_LOCK = threading.Lock()
+
+def get_rembg_session():
+    """Create the shared rembg session on first use and reuse it for every image"""
+    global REMBG_SESSION, REMBG_SESSION_LOADED
+    with REMBG_SESSION_LOCK:
+        # Only try once; a failed attempt leaves rembg on its per-call default session
+        if not REMBG_SESSION_LOADED:
+            REMBG_SESSION = create_rembg_session()
+            REMBG_SESSION_LOADED = True
+    return REMBG_SESSION
+
+# lxml is a C parser and much faster than the pure-Python html.parser; use it when installed
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# selectolax's Lexbor parser is a C HTML5 parser several times faster than BeautifulSoup, even on
+# lxml; product pages are parsed with it when it's installed
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# Headers to mimic a browser, sent with every request to avoid being blocked
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'DNT': '1',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# Shared session so the searches, product pages and image downloads reuse keep-alive connections
+# to lookfantastic.com and static.thcdn.com instead of a new TCP+TLS handshake per request
+SESSION = requests.Session()
+SESSION.headers.update(BROWSER_HEADERS)
+HTTP_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.3))
+SESSION.mount('https://', HTTP_ADAPTER)
+SESSION.mount('http://', HTTP_ADAPTER)
+
+# Product tiles and image markup come well before this point on LookFantastic pages, so stop reading
+# HTML there rather than downloading and parsing multi-MB pages in full
+MAX_HTML_BYTES = 1024 * 1024
+
+def read_html(response, limit=MAX_HTML_BYTES, chunk_size=65536):
+    """Read at most limit bytes of a streamed HTML response and decode them"""
+    chunks = []
+    received = 0
+    for chunk in response.iter_content(chunk_size):
+        chunks.append(chunk)
+        received += len(chunk)
+        if received >= limit:
+            break
+    response.close()
+    # A multi-byte character cut off at the limit decodes as a replacement character
+    return b''.join(chunks)[:limit].decode(response.encoding or 'utf-8', errors='replace')
+
+# Patterns used to scan LookFantastic pages, compiled once instead of on every call
+PRODUCT_HREF_PATTERNS = [
+    re.compile(r'href="(https://www\.lookfantastic\.com[^"]*?/products/[^"]*?)"'),
+    re.compile(r'href="(/[^"]*?/products/[^"]*?)"'),
+]
+# Product tiles on a listing page; only these subtrees are parsed from search results
+PRODUCT_TILE_STRAINER = SoupStrainer(attrs={'class': re.compile(r'^product(?:Block|Item)$')})
+# Small thumbnails and UI elements rather than product shots
+NON_PRODUCT_IMAGE_RE = re.compile(r'icon|thumb|logo', re.IGNORECASE)
+IMAGE_EXTENSION_RE = re.compile(r'\.(?:jpe?g|png|webp)', re.IGNORECASE)
+JSON_IMAGE_URL_RE = re.compile(r'"imageUrl"\s*:\s*"(https:[^"]+)"')
+# thcdn image URLs in data-src-desktop and src attributes, including ones behind the
+# lookfantastic.com/images?url= proxy (only when followed by more parameters). The pattern starts
+# with a literal so the scan stays fast; the attribute name is checked on each hit.
+STATIC_IMAGE_URL_RE = re.compile(
+    r'="https://(?:www\.lookfantastic\.com/images\?url=(?P<wrapped>https://static\.thcdn\.com[^"&]*)&[^"]*'
+    r'|(?P<static>static\.thcdn\.com[^"]*))"'
+)
+
+class NotFound(Exception):
+    """Raised inside cache_found to keep a failed lookup out of the cache"""
+
+def cache_found(maxsize=512):
+    """lru_cache that only remembers lookups that found something, so failures are retried"""
+    def decorator(func):
+        @lru_cache(maxsize=maxsize)
+        def cached(*args):
+            result = func(*args)
+            if result is None:
+                raise NotFound()
+            return result
+        
+        @wraps(func)
+        def wrapper(*args):
+            try:
+                return cached(*args)
+            except NotFound:
+                return None
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
 def search_product_on_lookfantastic(product_name, brand):
     """Search for a product on LookFantastic and return the product URL"""
+    # LookFantastic search is case-insensitive, so normalise the query to share cache entries
+    return search_lookfantastic(f"{brand.strip()} {product_name.strip()}".lower())
+
+@cache_found(maxsize=512)
+def search_lookfantastic(search_query):
+    """Search LookFantastic for a query and return the first product URL"""
     try:
-        print(f"Searching for {brand} {product_name} on LookFantastic...")
+        print(f"Searching for {search_query} on LookFantastic...")
         
-        # Format the search query
-        search_query = f"{brand} {product_name}"
+        # Format the search URL
         search_url = f"https://www.lookfantastic.com/search?q={quote_plus(search_query)}"
         
-        # Create headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.lookfantastic.com/',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        # Send the request
-        response = requests.get(search_url, headers=headers, timeout=15)
+        # Send the request (the session sends the browser headers)
+        response = SESSION.get(search_url, headers={'Referer': 'https://www.lookfantastic.com/'}, timeout=15, stream=True)
         
         if response.status_code != 200:
             print(f"Failed to search LookFantastic: {response.status_code}")
+            response.close()
             return None
+        html = read_html(response)
         
-        # Parse the HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # Parse only the product tiles out of the listing page; the rest of the DOM is never built
+        soup = BeautifulSoup(html, HTML_PARSER, parse_only=PRODUCT_TILE_STRAINER)
         
         # Find product links
         product_links = []
@@ -47,7 +184,8 @@ def search_product_on_lookfantastic(product_name, brand):
             product_elements = soup.select('.productItem')
         
         if not product_elements:
-            # Try another alternative selector
+            # Try another alternative selector; this one needs the full page
+            soup = BeautifulSoup(html, HTML_PARSER)
             product_elements = soup.select('[data-bind*="product"]')
         
         for product in product_elements:
@@ -64,13 +202,8 @@ def search_product_on_lookfantastic(product_name, brand):
             print("No products found with BeautifulSoup selectors, trying regex patterns...")
             
             # Multiple regex patterns to find product URLs
-            patterns = [
-                r'href="(https://www\.lookfantastic\.com[^"]*?/products/[^"]*?)"',
-                r'href="(/[^"]*?/products/[^"]*?)"'
-            ]
-            
-            for pattern in patterns:
-                matches = re.findall(pattern, response.text)
+            for pattern in PRODUCT_HREF_PATTERNS:
+                matches = pattern.findall(html)
                 for match in matches:
                     url = match
                     if not url.startswith('http'):
@@ -81,7 +214,7 @@ def search_product_on_lookfantastic(product_name, brand):
             product_links = list(set(product_links))
         
         if not product_links:
-            print(f"No products found for {brand} {product_name} on LookFantastic")
+            print(f"No products found for {search_query} on LookFantastic")
             return None
         
         # Return the first product link
@@ -92,189 +225,181 @@ def search_product_on_lookfantastic(product_name, brand):
         traceback.print_exc()
         return None
 
+# Image elements on a product page, in order of preference: (CSS selector, URL attribute, first only)
+PRODUCT_IMAGE_SELECTORS = [
+    ('img.athenaProductImageCarousel_image', 'src', True),  # Main product image
+    ('img[data-src*="thcdn.com"]', 'data-src', False),     # Lazy-loaded images
+    ('.productImage img', 'src', False),                    # Another common selector pattern
+]
+
+def product_image_element_urls(html):
+    """Image URLs from a product page's image elements, in order of preference"""
+    urls = []
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html)
+        for selector, attribute, first_only in PRODUCT_IMAGE_SELECTORS:
+            nodes = tree.css(selector)
+            for node in nodes[:1] if first_only else nodes:
+                urls.append(node.attributes.get(attribute))
+    else:
+        soup = BeautifulSoup(html, HTML_PARSER)
+        for selector, attribute, first_only in PRODUCT_IMAGE_SELECTORS:
+            for node in soup.select(selector, limit=1 if first_only else None):
+                urls.append(node.get(attribute))
+    # Attributes without a value can't be image URLs
+    return [url for url in urls if url]
+
+@cache_found(maxsize=512)
 def get_product_image_from_lookfantastic(product_url):
     """Extract the product image from a LookFantastic product page"""
     try:
         print(f"Extracting image from {product_url}...")
         
-        # Create headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        # Send the request
-        response = requests.get(product_url, headers=headers, timeout=15)
+        # Send the request (the session sends the browser headers)
+        response = SESSION.get(product_url, timeout=15, stream=True)
         
         if response.status_code != 200:
             print(f"Failed to access product page: {response.status_code}")
+            response.close()
             return None
+        html = read_html(response)
         
-        # Parse HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Try multiple selectors for product images
-        img_urls = []
-        
-        # Look for main product image
-        main_img = soup.select_one('img.athenaProductImageCarousel_image')
-        if main_img and 'src' in main_img.attrs:
-            img_urls.append(main_img['src'])
-        
-        # Try data-src attributes for lazy-loaded images
-        lazy_imgs = soup.select('img[data-src*="thcdn.com"]')
-        for img in lazy_imgs:
-            if 'data-src' in img.attrs:
-                img_urls.append(img['data-src'])
-        
-        # Try another common selector pattern
-        product_imgs = soup.select('.productImage img')
-        for img in product_imgs:
-            if 'src' in img.attrs:
-                img_urls.append(img['src'])
-        
-        # Extract image URLs from JSON data in the page
-        json_pattern = r'"imageUrl"\s*:\s*"(https:[^"]+)"'
-        json_matches = re.findall(json_pattern, response.text)
-        img_urls.extend(json_matches)
-        
-        # Pattern match directly in HTML for specific patterns
-        static_patterns = [
-            'data-src-desktop="https://static.thcdn.com/p',
-            'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com',
-            'src="https://static.thcdn.com'
-        ]
-        
-        for pattern in static_patterns:
-            start_index = 0
-            while True:
-                pattern_start = response.text.find(pattern, start_index)
-                if pattern_start == -1:
-                    break
-                
-                # Extract the URL based on pattern
-                if pattern == 'data-src-desktop="https://static.thcdn.com/p':
-                    quote_start = pattern_start + len('data-src-desktop="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        img_urls.append(img_url)
-                elif pattern == 'src="https://www.lookfantastic.com/images?url=https://static.thcdn.com':
-                    quote_start = pattern_start + len('src="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        # Extract the actual image URL from the parameter
-                        url_param_start = img_url.find("url=") + 4
-                        url_param_end = img_url.find("&", url_param_start)
-                        if url_param_end > url_param_start:
-                            direct_url = img_url[url_param_start:url_param_end]
-                            # URL might be URL encoded
-                            try:
-                                from urllib.parse import unquote
-                                direct_url = unquote(direct_url)
-                                img_urls.append(direct_url)
-                            except:
-                                img_urls.append(direct_url)
-                elif pattern == 'src="https://static.thcdn.com':
-                    quote_start = pattern_start + len('src="')
-                    quote_end = response.text.find('"', quote_start)
-                    if quote_end > quote_start:
-                        img_url = response.text[quote_start:quote_end]
-                        img_urls.append(img_url)
-                
-                start_index = pattern_start + len(pattern)
-        
-        # Filter out non-product images and duplicates
+        # Candidate image URLs in order of preference, de-duplicated and filtered as they're found
         filtered_urls = []
         seen = set()
-        for url in img_urls:
+        
+        def add_url(url):
             # Normalize URL to avoid duplicates
             url = url.strip()
             if url in seen:
-                continue
+                return
             seen.add(url)
             
-            # Skip small thumbnails and UI elements
-            if 'icon' in url.lower() or 'thumb' in url.lower() or 'logo' in url.lower():
-                continue
-            
-            # Skip non-image URLs
-            if not any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                continue
-                
+            # Skip small thumbnails and UI elements, and non-image URLs
+            if NON_PRODUCT_IMAGE_RE.search(url) or not IMAGE_EXTENSION_RE.search(url):
+                return
             filtered_urls.append(url)
         
+        # Try multiple selectors for product images, starting with the main product image
+        for url in product_image_element_urls(html):
+            add_url(url)
+        
+        # Extract image URLs from JSON data in the page
+        for url in JSON_IMAGE_URL_RE.findall(html):
+            add_url(url)
+        
+        # Pattern match directly in HTML for thcdn image URLs, all three patterns in one scan.
+        # Desktop images come first, then ones wrapped in LookFantastic's image proxy, then plain src.
+        direct_urls, wrapped_urls, plain_urls = [], [], []
+        for match in STATIC_IMAGE_URL_RE.finditer(html):
+            if html.endswith('data-src-desktop', 0, match.start()):
+                static_url = match.group('static')
+                if static_url and static_url.startswith('static.thcdn.com/p'):
+                    direct_urls.append(f"https://{static_url}")
+            elif html.endswith('src', 0, match.start()):
+                if match.group('wrapped'):
+                    # URL might be URL encoded
+                    wrapped_urls.append(unquote(match.group('wrapped')))
+                else:
+                    plain_urls.append(f"https://{match.group('static')}")
+        for url in direct_urls + wrapped_urls + plain_urls:
+            add_url(url)
+        
         if not filtered_urls:
             print("Could not find any product images on the page")
             return None
         
-        # Return the first high-quality image
-        return filtered_urls[0]
+        # Return the first high-quality image that actually exists
+        return first_available_image(filtered_urls)
     
     except Exception as e:
         print(f"Error extracting product image: {e}")
         traceback.print_exc()
         return None
 
-def download_image(url):
-    """Download an image and return it as a PIL Image object"""
+# Product images are shrunk to fit this before background removal, matching the server
+PRODUCT_IMAGE_MAX_SIZE = 1500
+
+# How many of the top candidate image URLs to check, all at once, before picking one
+IMAGE_CANDIDATES_TO_CHECK = 4
+VALIDATION_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+def image_url_available(url):
+    """Whether a HEAD request for the image URL succeeds"""
+    try:
+        response = SESSION.head(url, timeout=5, allow_redirects=True)
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def first_available_image(urls):
+    """The most preferred of the top candidate URLs that the CDN actually serves"""
+    # The first candidate often 404s; checking the top few in parallel costs one round trip and
+    # saves a failed download downstream
+    candidates = urls[:IMAGE_CANDIDATES_TO_CHECK]
+    checks = [VALIDATION_EXECUTOR.submit(image_url_available, url) for url in candidates]
+    for url, check in zip(candidates, checks):
+        if check.result():
+            return url
+    
+    # None answered the HEAD request (some hosts reject HEAD), so fall back to the first candidate
+    print("Could not verify any candidate image URLs, using the first one")
+    return urls[0]
+
+def download_image_bytes(url):
+    """Download an image and return its raw bytes and mimetype"""
     try:
         # Skip placeholder images
         if "placeholder.com" in url:
             print(f"Skipping placeholder image")
-            return None
+            return None, None
             
-        # Create a request with a User-Agent header to avoid being blocked
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        
-        # Direct download for image URLs
-        response = requests.get(url, headers=headers, timeout=10)
+        # Direct download for image URLs over a pooled connection
+        response = SESSION.get(url, timeout=10)
         
         # Check if response is successful
         if response.status_code != 200:
             print(f"Failed to download image: {response.status_code}")
-            return None
+            return None, None
             
         # Check if response is an image
         content_type = response.headers.get('Content-Type', '')
         if 'image' in content_type:
-            # Load image from response content
-            image = Image.open(BytesIO(response.content))
-            return image
+            return response.content, content_type.split(';')[0].strip()
         else:
             print(f"URL does not point to an image: {url}")
-            return None
+            return None, None
     except Exception as e:
         print(f"Error downloading image from {url}: {str(e)}")
         traceback.print_exc()
+        return None, None
+
+def download_image(url):
+    """Download an image and return it as a PIL Image object"""
+    image_bytes, _ = download_image_bytes(url)
+    if not image_bytes:
+        return None
+    
+    try:
+        # Load image from response content
+        return Image.open(BytesIO(image_bytes))
+    except Exception as e:
+        print(f"Error opening image from {url}: {str(e)}")
+        traceback.print_exc()
         return None
 
-def remove_background(image):
+def remove_background(image, alpha_matting=False):
     """Remove background from an image using rembg"""
+    if rembg_remove is None:
+        return image
+    
     try:
-        # Try to import rembg
-        try:
-            from rembg import remove
-            
-            # Process with rembg
-            output = remove(image, alpha_matting=True)
-            
-            # Return the processed image
-            return output
-        except ImportError:
-            print("rembg not installed. Installing...")
-            import subprocess
-            subprocess.check_call(["pip", "install", "rembg"])
-            
-            # Try again after installation
-            from rembg import remove
-            output = remove(image, alpha_matting=True)
-            return output
+        # Process with rembg. Alpha matting solves a matting problem over the whole image and costs
+        # several times the u2net pass itself, for little gain on product shots, so it's opt-in.
+        output = rembg_remove(image, session=get_rembg_session(), alpha_matting=alpha_matting)
+        
+        # Return the processed image
+        return output
     except Exception as e:
         print(f"Error removing background: {e}")
         traceback.print_exc()
@@ -292,27 +417,149 @@ def find_product_image(product_name, brand, product_type=None):
     
     return {"image_url": None, "product_url": None}
 
-def process_product_image(image_url):
-    """Download an image and remove the background"""
-    if not image_url:
+# Concurrent product lookups when finding images for many products; kept small so we don't hammer
+# LookFantastic
+LOOKUP_WORKERS = 5
+
+def find_product_images(products):
+    """Find product images for many (product_name, brand) pairs at once, in the same order"""
+    # Each lookup is two page fetches that mostly wait on the network, so overlapping them makes
+    # a batch take about as long as its slowest lookup rather than the sum of them all
+    with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+        return list(executor.map(lambda product: find_product_image(*product), products))
+
+# Processed product images, stored as data URLs keyed by a hash of the image URL. thcdn image URLs
+# never change content, so a hit skips the download, background removal and encoding entirely.
+PRODUCT_CACHE_DIR = os.environ.get('PRODUCT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'mirror_img_cache'))
+PRODUCT_CACHE_MAX_BYTES = int(os.environ.get('PRODUCT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+os.makedirs(PRODUCT_CACHE_DIR, exist_ok=True)
+
+def product_cache_path(image_url, alpha_matting):
+    """Cache file for a processed image URL and its background removal options"""
+    key = hashlib.sha1(f"{image_url}|alpha_matting={alpha_matting}".encode()).hexdigest()
+    return os.path.join(PRODUCT_CACHE_DIR, key)
+
+def prune_product_cache(max_bytes=PRODUCT_CACHE_MAX_BYTES):
+    """Delete the least recently used cached images until the cache fits in max_bytes"""
+    entries = []
+    total = 0
+    with os.scandir(PRODUCT_CACHE_DIR) as it:
+        for entry in it:
+            # .tmp files are cache writes still in progress in another thread
+            if entry.is_file(follow_symlinks=False) and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+def read_cached_product_image(image_url, alpha_matting=False):
+    """The cached data URL for a processed image URL, or None"""
+    cache_path = product_cache_path(image_url, alpha_matting)
+    try:
+        with open(cache_path) as f:
+            data_url = f.read()
+        # Bump the mtime so pruning treats this as recently used
+        os.utime(cache_path)
+        return data_url
+    except OSError:
         return None
-        
-    # Download the image
-    image = download_image(image_url)
-    if not image:
+
+def fetch_product_image(image_url, alpha_matting=False):
+    """Network half of processing: returns (cached data URL, None, None) or (None, bytes, mimetype)"""
+    if not image_url:
+        return None, None, None
+    
+    data_url = read_cached_product_image(image_url, alpha_matting)
+    if data_url:
+        return data_url, None, None
+    
+    # Download the image, keeping the original bytes in case background removal doesn't happen
+    image_bytes, content_type = download_image_bytes(image_url)
+    return None, image_bytes, content_type
+
+def process_product_image(image_url, alpha_matting=False):
+    """Download an image and remove the background"""
+    data_url, image_bytes, content_type = fetch_product_image(image_url, alpha_matting)
+    if data_url or not image_bytes:
+        return data_url
+    return remove_product_background(image_url, image_bytes, content_type, alpha_matting)
+
+def remove_product_background(image_url, image_bytes, content_type, alpha_matting=False):
+    """Compute half of processing: remove the background from downloaded bytes and cache the data URL"""
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        if rembg_remove is not None and max(image.size) > PRODUCT_IMAGE_MAX_SIZE:
+            # rembg's cost grows with pixel count, so shrink first; thumbnail lets libjpeg decode
+            # JPEGs at a reduced scale and box-reduces before the final LANCZOS pass
+            image.thumbnail((PRODUCT_IMAGE_MAX_SIZE, PRODUCT_IMAGE_MAX_SIZE), Image.LANCZOS, reducing_gap=3.0)
+    except Exception as e:
+        print(f"Error opening image from {image_url}: {str(e)}")
         return None
         
     # Remove background
-    processed_image = remove_background(image)
+    processed_image = remove_background(image, alpha_matting=alpha_matting)
     if not processed_image:
         return None
+    
+    if processed_image is image:
+        # Background removal failed or isn't available. The download is already an image the
+        # client can display, so pass its bytes through instead of re-encoding them as PNG.
+        return make_data_url(image_bytes, content_type)
         
-    # Convert to base64
-    buffered = BytesIO()
-    processed_image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    # Convert to base64, straight from the buffer without copying the PNG bytes out first
+    with BytesIO() as buffered:
+        # zlib level 6 dominates the encode time and barely shrinks matted output, so use level 1
+        processed_image.save(buffered, format="PNG", compress_level=1)
+        with buffered.getbuffer() as png_bytes:
+            data_url = make_data_url(png_bytes, 'image/png')
+    
+    # Cache it, writing to a temporary name first so readers never see a partial file
+    try:
+        cache_path = product_cache_path(image_url, alpha_matting)
+        fd, temp_path = tempfile.mkstemp(dir=PRODUCT_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data_url)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        prune_product_cache()
+    except OSError as e:
+        print(f"Could not cache processed image: {e}")
+    
+    return data_url
+
+# Pools for processing many product images: downloads mostly wait on the network, while background
+# removal keeps a couple of cores busy (the shared rembg session can run calls concurrently)
+DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+REMOVAL_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def process_product_images(image_urls, alpha_matting=False):
+    """Process many product images, overlapping downloads with background removal, in the same order"""
+    downloads = {DOWNLOAD_EXECUTOR.submit(fetch_product_image, url, alpha_matting): i
+                 for i, url in enumerate(image_urls)}
+    removals = [None] * len(image_urls)
     
-    return f"data:image/png;base64,{img_str}"
+    # Hand each image to background removal as soon as its own download finishes
+    for download in as_completed(downloads):
+        i = downloads[download]
+        data_url, image_bytes, content_type = download.result()
+        if data_url or not image_bytes:
+            removals[i] = Future()
+            removals[i].set_result(data_url)
+        else:
+            removals[i] = REMOVAL_EXECUTOR.submit(remove_product_background, image_urls[i],
+                                                  image_bytes, content_type, alpha_matting)
+    return [removal.result() for removal in removals]
 
 # For testing
 if __name__ == "__main__":
@@ -37,7 +37,7 @@ pip uninstall -y rembg onnxruntime
 
 # Install required packages
 echo "Installing required packages..."
-pip install flask flask-cors pillow requests beautifulsoup4
+pip install flask flask-cors pillow requests beautifulsoup4 lxml pybase64 selectolax gunicorn
 
 # Install PyTorch CPU-only version first (necessary for carvekit)
 echo "Installing PyTorch CPU-only version..."
@@ -54,4 +54,4 @@ pip install numpy
 # Start the server
 echo "Starting server..."
 cd "$(dirname "$0")"  # Navigate to the directory of this script
-python3 app.py 
\ No newline at end of file
+gunicorn -c gunicorn_conf.py app:app 
\ No newline at end of file